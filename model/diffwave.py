@@ -746,7 +746,17 @@ class ClassifierFreeDiffRoll(SpecRollDiffusion):
                 spec[:, int(inpainting_f[0]):int(inpainting_f[1]), int(
                     inpainting_t[0]):int(inpainting_t[1])] = -1
 
-            if sampling == True:
+            if isinstance(sampling, torch.Tensor):
+                # sampling is a (B,) bool mask, only the masked examples are unconditional
+                if self.hparams.condition == 'trainable_spec':
+                    uncon_spec = self.trainable_parameters
+                elif self.hparams.condition == 'trainable_z' or self.hparams.condition == 'fixed':
+                    uncon_spec = torch.full_like(spec, -1)
+                x_t, spec = trim_spec_roll(x_t, spec)
+                x_t, uncon_spec = trim_spec_roll(x_t, uncon_spec)
+                spec = torch.where(sampling[:, None, None],
+                                   uncon_spec, spec[..., :x_t.shape[-1]])
+            elif sampling == True:
                 if self.hparams.condition == 'trainable_spec':
                     spec = self.trainable_parameters
                 elif self.hparams.condition == 'trainable_z' or self.hparams.condition == 'fixed':
@@ -878,7 +888,15 @@ class ClassifierFreeLatentRoll(LatentRollDiffusion):
         # if sampling and self.hparams.condition == 'trainable_latent':
         #     dac_latents = self.trainable_parameters.expand(
         #         x_t.shape[0], -1, -1)
-        if sampling == True:
+        if isinstance(sampling, torch.Tensor):
+            # sampling is a (B,) bool mask, only the masked examples are unconditional
+            if self.hparams.condition == 'trainable_latent':
+                uncon_latents = self.trainable_parameters
+            elif self.hparams.condition == 'trainable_z' or self.hparams.condition == 'fixed':
+                uncon_latents = torch.full_like(dac_latents, -1)
+            dac_latents = torch.where(sampling[:, None, None],
+                                      uncon_latents, dac_latents)
+        elif sampling == True:
             if self.hparams.condition == 'trainable_latent':
                 dac_latents = self.trainable_parameters  # TODO: fix esp this
             elif self.hparams.condition == 'trainable_z' or self.hparams.condition == 'fixed':
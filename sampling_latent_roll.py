@@ -57,7 +57,8 @@ def main(cfg):
         model = getattr(Model, cfg.model.name).load_from_checkpoint(to_absolute_path(cfg.checkpoint_path),
                                                                     sampling=cfg.task.sampling,
                                                                     frame_threshold=cfg.task.frame_threshold,
-                                                                    timesteps=cfg.task.timesteps)
+                                                                    timesteps=cfg.task.timesteps,
+                                                                    bf16_sampling=cfg.task.bf16_sampling)
                                                                     # generation_filter=cfg.task.generation_filter,
                                                                     # inpainting_t=cfg.task.inpainting_t,
                                                                     # inpainting_f=cfg.task.inpainting_f)
@@ -66,7 +67,8 @@ def main(cfg):
                                                                     sampling=cfg.task.sampling,
                                                                     generation_filter=cfg.task.generation_filter,
                                                                     inpainting_t=cfg.task.inpainting_t,
-                                                                    inpainting_f=cfg.task.inpainting_f)
+                                                                    inpainting_f=cfg.task.inpainting_f,
+                                                                    bf16_sampling=cfg.task.bf16_sampling)
 
     name = f"Generation-{cfg.model.name}-k={cfg.model.args.kernel_size}"
     logger = TensorBoardLogger(save_dir=".", version=1, name=name)
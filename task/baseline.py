@@ -6,8 +6,7 @@ import torch.nn.functional as F
 import torch.nn as nn
 import matplotlib.pyplot as plt
 from tqdm import tqdm
-from sklearn.metrics import precision_recall_fscore_support
-from .utils import extract_notes_wo_velocity
+from .utils import extract_notes_wo_velocity, frame_precision_recall_f1
 from mir_eval.transcription import precision_recall_f1_overlap as evaluate_notes
 from mir_eval.util import midi_to_hz
 import numpy as np
@@ -25,16 +24,17 @@ def q_sample(x_start, t, sqrt_alphas_cumprod, sqrt_one_minus_alphas_cumprod, noi
     """
     
     # sqrt_alphas is mean of the Gaussian N()    
-    sqrt_alphas_cumprod_t = sqrt_alphas_cumprod[t]# extract the value of \bar{\alpha} at time=t
+    # extract the value of \bar{\alpha} at time=t with a single gather kernel,
+    # the schedule is a module buffer so it is already on the device of x_start
+    sqrt_alphas_cumprod_t = sqrt_alphas_cumprod.index_select(0, t)
     # sqrt_alphas is variance of the Gaussian N()
-    sqrt_one_minus_alphas_cumprod_t = sqrt_one_minus_alphas_cumprod[t]
+    sqrt_one_minus_alphas_cumprod_t = sqrt_one_minus_alphas_cumprod.index_select(0, t)
     
     # boardcasting into correct shape
-    sqrt_alphas_cumprod_t = sqrt_alphas_cumprod_t[:, None, None, None].to(x_start.device)
-    sqrt_one_minus_alphas_cumprod_t = sqrt_one_minus_alphas_cumprod_t[:, None, None, None].to(x_start.device)
+    sqrt_alphas_cumprod_t = sqrt_alphas_cumprod_t.view(-1, 1, 1, 1)
+    sqrt_one_minus_alphas_cumprod_t = sqrt_one_minus_alphas_cumprod_t.view(-1, 1, 1, 1)
 
     # scale down the input, and scale up the noise as time increases?
-    output = sqrt_alphas_cumprod_t * x_start + sqrt_one_minus_alphas_cumprod_t * noise
     return sqrt_alphas_cumprod_t * x_start + sqrt_one_minus_alphas_cumprod_t * noise
 
 
@@ -57,25 +57,34 @@ class SpecRollBaseline(pl.LightningModule):
         # define beta schedule
         # beta is variance
         self.timesteps = 200
-        self.betas = linear_beta_schedule(beta_start, beta_end, timesteps=timesteps)
+        betas = linear_beta_schedule(beta_start, beta_end, timesteps=timesteps)
 
         # define alphas 
-        alphas = 1. - self.betas
+        alphas = 1. - betas
         alphas_cumprod = torch.cumprod(alphas, axis=0)
         alphas_cumprod_prev = F.pad(alphas_cumprod[:-1], (1, 0), value=1.0)
-        self.sqrt_recip_alphas = torch.sqrt(1.0 / alphas)
+
+        # the schedule is registered as non-persistent buffers so that it follows
+        # the module to its device without being stored in the checkpoints
+        self.register_buffer('betas', betas, persistent=False)
+        self.register_buffer('alphas', alphas, persistent=False)
+        self.register_buffer('sqrt_recip_alphas', torch.sqrt(1.0 / alphas), persistent=False)
 
         # calculations for diffusion q(x_t | x_{t-1}) and others
-        self.sqrt_alphas_cumprod = torch.sqrt(alphas_cumprod)
-        self.sqrt_one_minus_alphas_cumprod = torch.sqrt(1. - alphas_cumprod)
+        self.register_buffer('sqrt_alphas_cumprod', torch.sqrt(alphas_cumprod), persistent=False)
+        self.register_buffer('sqrt_one_minus_alphas_cumprod', torch.sqrt(1. - alphas_cumprod),
+                             persistent=False)
 
         # calculations for posterior q(x_{t-1} | x_t, x_0)
-        self.posterior_variance = self.betas * (1. - alphas_cumprod_prev) / (1- alphas_cumprod)
-        self.alphas = alphas
+        self.register_buffer('posterior_variance',
+                             betas * (1. - alphas_cumprod_prev) / (1- alphas_cumprod),
+                             persistent=False)
         
         # === End of debugging====
         
-        
+        # reusable device buffers for the per-step timestep tensor and noise
+        self._t_buf = None
+        self._noise_buf = None
         
         self.save_hyperparameters()
         
@@ -243,9 +252,8 @@ class SpecRollBaseline(pl.LightningModule):
             #======== Animation saved ===========
             
             
-        frame_p, frame_r, frame_f1, _ = precision_recall_fscore_support(roll_label.flatten(),
-                                                                        roll_pred.flatten()>self.hparams.frame_threshold,
-                                                                        average='binary')
+        frame_p, frame_r, frame_f1 = frame_precision_recall_f1(roll_label,
+                                                               roll_pred > self.hparams.frame_threshold)
         
         for roll_pred_i, roll_label_i in zip(roll_pred, roll_label.numpy()):
             # roll_pred (B, 1, T, F)
@@ -268,15 +276,16 @@ class SpecRollBaseline(pl.LightningModule):
 
             # Converting time steps to seconds and midi number to frequency
             i_ref = (i_ref * scaling).reshape(-1, 2)
-            p_ref = np.array([midi_to_hz(MIN_MIDI + midi) for midi in p_ref])
+            p_ref = midi_to_hz(MIN_MIDI + p_ref)
             i_est = (i_est * scaling).reshape(-1, 2)
-            p_est = np.array([midi_to_hz(MIN_MIDI + midi) for midi in p_est])
+            p_est = midi_to_hz(MIN_MIDI + p_est)
 
             p, r, f, o = evaluate_notes(i_ref, p_ref, i_est, p_est, offset_ratio=None)            
         
             self.log("Test/Note_F1", f)         
         self.log("Test/Frame_F1", frame_f1)
         
+    @torch.inference_mode()
     def sampling(self, batch, batch_idx):
         batch_size = batch["frame"].shape[0]
         waveform = batch["audio"]
@@ -297,6 +306,21 @@ class SpecRollBaseline(pl.LightningModule):
         
         return noise_list, spec
     
+    def t_tensor(self, x, t_index):
+        # boardcasting t_index into a reusable device tensor
+        # (avoids allocating a new tensor on every reverse step)
+        if self._t_buf is None or self._t_buf.shape[0] < x.shape[0] or self._t_buf.device != x.device:
+            self._t_buf = torch.empty(
+                x.shape[0], dtype=torch.long, device=x.device)
+        return self._t_buf[:x.shape[0]].fill_(t_index)
+
+    def noise_like(self, x):
+        # in-place normal_() into a reused buffer instead of a fresh randn_like per step
+        if self._noise_buf is None or self._noise_buf.shape != x.shape or \
+                self._noise_buf.device != x.device or self._noise_buf.dtype != x.dtype:
+            self._noise_buf = torch.empty_like(x)
+        return self._noise_buf.normal_()
+
     def reverse_diffusion(self, x, waveform, t_index):
         # x is Guassian noise
         
@@ -305,15 +329,7 @@ class SpecRollBaseline(pl.LightningModule):
         sqrt_one_minus_alphas_cumprod_t = self.sqrt_one_minus_alphas_cumprod[t_index]
         sqrt_recip_alphas_t = self.sqrt_recip_alphas[t_index]
 
-        # boardcasting t_index into a tensor
-        t_tensor = torch.tensor(t_index).repeat(x.shape[0]).to(x.device)
-        
-        # Equation 11 in the paper
-        # Use our model (noise predictor) to predict the mean 
-        x0_pred, spec = self(x, waveform, t_tensor)
-        
-        # boardcasting t_index into a tensor
-        t_tensor = torch.tensor(t_index).repeat(x.shape[0]).to(x.device)
+        t_tensor = self.t_tensor(x, t_index)
 
         # Equation 11 in the paper
         # Use our model (noise predictor) to predict the mean 
@@ -329,7 +345,7 @@ class SpecRollBaseline(pl.LightningModule):
             model_mean = (self.sqrt_alphas_cumprod[t_index-1]) * x0_pred + (
                 torch.sqrt(1 - self.sqrt_alphas_cumprod[t_index-1]**2 - sigma**2) * (
                     x-self.sqrt_alphas_cumprod[t_index]* x0_pred)/self.sqrt_one_minus_alphas_cumprod[t_index]) + (
-                sigma * torch.randn_like(x))
+                sigma * self.noise_like(x))
 
         return model_mean, spec           
         
@@ -355,6 +371,7 @@ class SpecRollBaseline(pl.LightningModule):
         row2_txt = ax_flat[4].text(-300,45,'x_{t-1}')            
         
         
+    @torch.inference_mode()
     def predict_step(self, batch, batch_idx):
         def animate_sampling(t_idx):
             # Tuple of (x_t, t), (x_t-1, t-1), ... (x_0, 0)
@@ -412,10 +429,16 @@ class SpecRollBaseline(pl.LightningModule):
 
             
     def visualize_figure(self, tensors, tag, batch_idx):
+        # only rank 0 logs, the other ranks skip the device->host copy
+        if not self.trainer.is_global_zero:
+            return
         fig, ax = plt.subplots(2,2)
-        for idx in range(4): # visualize only 4 piano rolls
-            # roll_pred (1, T, F)
-            ax.flatten()[idx].imshow(tensors[idx][0].T.cpu(), aspect='auto', origin='lower')
+        flat_ax = ax.flatten()
+        # visualize only 4 piano rolls, copied to host in a single transfer
+        rolls = tensors[:4, 0].detach().transpose(-1, -2).cpu()
+        for idx in range(4):
+            # roll (F, T)
+            flat_ax[idx].imshow(rolls[idx], aspect='auto', origin='lower')
         self.logger.experiment.add_figure(f"{tag}{idx}", fig, global_step=self.current_epoch)
         plt.close()
         
@@ -434,11 +457,11 @@ class SpecRollBaseline(pl.LightningModule):
         # t_tensor = t.repeat(batch_size).to(roll.device)
         
         if self.hparams.time_mode == 'constant':
-            t = torch.ones((batch_size,), device=device).long() # more diverse sampling
+            t = torch.ones((batch_size,), dtype=torch.long, device=device) # more diverse sampling
         if self.hparams.time_mode == 'constant_maxT':
-            t = torch.full((batch_size,), self.hparams.timesteps-1, device=device).long() # more diverse sampling            
+            t = torch.full((batch_size,), self.hparams.timesteps-1, dtype=torch.long, device=device) # more diverse sampling            
         elif self.hparams.time_mode == 'random':
-            t = torch.randint(low=0,high=100,size=(batch_size,)) # more diverse sampling
+            t = torch.randint(low=0,high=100,size=(batch_size,), device=device) # more diverse sampling
         else:
             raise ValueError(f'{self.hparams.time_mode=} is not recognized')            
         
@@ -1,6 +1,9 @@
 from mir_eval.util import hz_to_midi
 from mido import Message, MidiFile, MidiTrack
 import os
+import functools
+import struct
+from concurrent.futures import ThreadPoolExecutor
 import pytorch_lightning as pl
 from pytorch_lightning.callbacks import LearningRateMonitor, ModelCheckpoint
 from pytorch_lightning.loggers import TensorBoardLogger
@@ -9,18 +12,26 @@ import torch.nn.functional as F
 import torch.nn as nn
 import matplotlib.pyplot as plt
 from tqdm import tqdm
-from sklearn.metrics import precision_recall_fscore_support
-from .utils import extract_notes_wo_velocity
+from .utils import extract_notes_wo_velocity, frame_precision_recall_f1
 from mir_eval.transcription import precision_recall_f1_overlap as evaluate_notes
 from mir_eval.util import midi_to_hz
 import numpy as np
 import matplotlib.animation as animation
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 import torchaudio
+from torchvision.utils import make_grid
 MIN_MIDI = 21
 MAX_MIDI = 108
 HOP_LENGTH = 160
 SAMPLE_RATE = 16000
+# seconds per frame of the DAC latent rolls
+LATENT_SCALING = 128 / 16000
+# frequency (Hz) of every piano key, indexed by bin
+PITCH_HZ = midi_to_hz(np.arange(MIN_MIDI, MAX_MIDI + 1))
+# save_midi writes the file bytes directly above this many notes instead of going through mido
+MIDI_FAST_PATH_MIN_NOTES = 2000
+# mido's default resolution, shared by both save_midi paths
+MIDI_TICKS_PER_BEAT = 480
 
 
 # from model.utils import Normalization
@@ -33,13 +44,132 @@ def cosine_beta_schedule(timesteps, s=0.008):
     '''
     s is the offset
     '''
+    # cached per (timesteps, s), a copy is returned so callers may modify it
+    return _cosine_beta_schedule(int(timesteps), float(s)).clone()
+
+
+@functools.lru_cache(maxsize=16)
+def _cosine_beta_schedule(timesteps, s):
     steps = timesteps + 1
     x = torch.linspace(0, timesteps, steps)
     alphas_cumprod = torch.cos(
         ((x / timesteps) + s) / (1 + s) * torch.pi * 0.5) ** 2
     alphas_cumprod = alphas_cumprod / alphas_cumprod[0]
     betas = 1 - (alphas_cumprod[1:] / alphas_cumprod[:-1])
-    return torch.clip(betas, 0.0001, 0.9999)
+    return betas.clamp_(0.0001, 0.9999)
+
+
+def x0_posterior_coefs(alphas_cumprod, alphas_cumprod_prev, eta):
+    """
+    Coefficients of the x0 parameterised update
+    x_prev = coef_x0 * x0_pred + coef_xt * x_t + sigma * noise
+    eta=1 gives the ddpm posterior and eta=0 the deterministic DDIM update.
+    At t=0 the update reduces to x0_pred / sqrt(alphas_cumprod[0]) without noise.
+    """
+    sigma = eta * torch.sqrt((1. - alphas_cumprod_prev) / (1. - alphas_cumprod) * (
+        1. - alphas_cumprod / alphas_cumprod_prev))
+    coef_xt = torch.sqrt(1. - alphas_cumprod_prev - sigma**2) / \
+        torch.sqrt(1. - alphas_cumprod)
+    coef_x0 = torch.sqrt(alphas_cumprod_prev) - \
+        torch.sqrt(alphas_cumprod) * coef_xt
+    coef_x0[0] = 1. / torch.sqrt(alphas_cumprod[0])
+    coef_xt[0] = 0.
+    sigma[0] = 0.
+    return coef_x0, coef_xt, sigma
+
+
+def make_schedule(betas, prev_t=None):
+    """
+    betas: (timesteps,) variance schedule
+    prev_t: (timesteps,) step each t jumps to in the DDIM update (-1 for x_0),
+            defaults to t-1
+    Precomputes the coefficients used by the forward and reverse processes.
+    The cumprod/sqrt chain runs once on CPU in float64, since 1 - alphas_cumprod
+    gets tiny at large t, and the results are cast back to float32.
+    """
+    betas = betas.double()
+    # define alphas
+    alphas = 1. - betas
+    alphas_cumprod = torch.cumprod(alphas, axis=0)
+    alphas_cumprod_prev = F.pad(alphas_cumprod[:-1], (1, 0), value=1.0)
+    if prev_t is None:
+        ddim_alphas_cumprod_prev = alphas_cumprod_prev
+    else:
+        ddim_alphas_cumprod_prev = torch.where(
+            prev_t >= 0, alphas_cumprod[prev_t.clamp(min=0)], 1.)
+
+    ddpm_x0_coef_x0, ddpm_x0_coef_xt, ddpm_x0_sigma = x0_posterior_coefs(
+        alphas_cumprod, alphas_cumprod_prev, eta=1.)
+    ddim_coef_x0, ddim_coef_xt, _ = x0_posterior_coefs(
+        alphas_cumprod, ddim_alphas_cumprod_prev, eta=0.)
+    # the same DDIM update from an epsilon prediction, x0 = (x_t - sqrt(1-a_t) * eps) / sqrt(a_t)
+    # folded in, at t=0 (prev = 1) it is exactly x0
+    ddim_eps_coef_xt = torch.sqrt(ddim_alphas_cumprod_prev / alphas_cumprod)
+    ddim_eps_coef_eps = torch.sqrt(1. - ddim_alphas_cumprod_prev) - \
+        ddim_eps_coef_xt * torch.sqrt(1. - alphas_cumprod)
+    # ddpm from an epsilon prediction, x_prev = (x_t - beta_t / sqrt(1-a_t) * eps) / sqrt(alpha_t)
+    ddpm_eps_coef_xt = torch.sqrt(1.0 / alphas)
+    ddpm_eps_coef_eps = -ddpm_eps_coef_xt * betas / torch.sqrt(1. - alphas_cumprod)
+    # ddim update with the ddpm posterior noise (eta=1) from an epsilon prediction,
+    # at t=0 (prev = 1, sigma = 0) it is exactly x0
+    ddim2ddpm_coef_xt = torch.sqrt(alphas_cumprod_prev / alphas_cumprod)
+    ddim2ddpm_coef_eps = torch.sqrt(1. - alphas_cumprod_prev - ddpm_x0_sigma**2) - \
+        ddim2ddpm_coef_xt * torch.sqrt(1. - alphas_cumprod)
+
+    schedule = {
+        'betas': betas,
+        'alphas': alphas,
+        'sqrt_recip_alphas': torch.sqrt(1.0 / alphas),
+        # calculations for diffusion q(x_t | x_{t-1}) and others
+        'sqrt_alphas_cumprod': torch.sqrt(alphas_cumprod),
+        'sqrt_one_minus_alphas_cumprod': torch.sqrt(1. - alphas_cumprod),
+        # calculations for posterior q(x_{t-1} | x_t, x_0)
+        'posterior_variance': betas * (1. - alphas_cumprod_prev) / (1. - alphas_cumprod),
+        # x0 parameterised reverse updates, see x0_posterior_coefs
+        'ddpm_x0_coef_x0': ddpm_x0_coef_x0,
+        'ddpm_x0_coef_xt': ddpm_x0_coef_xt,
+        'ddpm_x0_sigma': ddpm_x0_sigma,
+        'ddim_coef_x0': ddim_coef_x0,
+        'ddim_coef_xt': ddim_coef_xt,
+        'ddim_eps_coef_xt': ddim_eps_coef_xt,
+        'ddim_eps_coef_eps': ddim_eps_coef_eps,
+        # epsilon parameterised ddpm updates, both use ddpm_x0_sigma as the noise scale
+        'ddpm_eps_coef_xt': ddpm_eps_coef_xt,
+        'ddpm_eps_coef_eps': ddpm_eps_coef_eps,
+        'ddim2ddpm_coef_xt': ddim2ddpm_coef_xt,
+        'ddim2ddpm_coef_eps': ddim2ddpm_coef_eps,
+    }
+    return {name: tensor.float() for name, tensor in schedule.items()}
+
+
+@torch.jit.script
+def _q_sample_fused(x_start, noise, sqrt_alphas_cumprod_t, sqrt_one_minus_alphas_cumprod_t):
+    # scripted so that the scale-and-add is fused into a single elementwise kernel
+    return sqrt_alphas_cumprod_t * x_start + sqrt_one_minus_alphas_cumprod_t * noise
+
+
+@torch.jit.script
+def _extract_x0_fused(x_t, epsilon, sqrt_alphas_cumprod_t, sqrt_one_minus_alphas_cumprod_t):
+    return (x_t - sqrt_one_minus_alphas_cumprod_t * epsilon) / sqrt_alphas_cumprod_t
+
+
+@torch.jit.script
+def _x0_step_fused(x_t, x0_pred, coef_x0, coef_xt):
+    return coef_x0 * x0_pred + coef_xt * x_t
+
+
+@torch.jit.script
+def _x0_noisy_step_fused(x_t, x0_pred, noise, coef_x0, coef_xt, sigma):
+    return coef_x0 * x0_pred + coef_xt * x_t + sigma * noise
+
+
+def gather_schedule(t, *schedules):
+    """
+    t: timestep information (B,)
+    Gathers every (timesteps,) schedule at t, shaped (B, 1, 1, 1) to broadcast
+    against the rolls. index_select is a single gather kernel per schedule.
+    """
+    return tuple(schedule.index_select(0, t).view(-1, 1, 1, 1) for schedule in schedules)
 
 
 def q_sample(x_start, t, sqrt_alphas_cumprod, sqrt_one_minus_alphas_cumprod, noise=None):
@@ -48,20 +178,14 @@ def q_sample(x_start, t, sqrt_alphas_cumprod, sqrt_one_minus_alphas_cumprod, noi
     t: timestep information (B,)
     """
     # sqrt_alphas is mean of the Gaussian N()
-    t = t.to(sqrt_alphas_cumprod.device)
-    # extract the value of \bar{\alpha} at time=t
-    sqrt_alphas_cumprod_t = sqrt_alphas_cumprod[t]
-    # sqrt_alphas is variance of the Gaussian N()
-    sqrt_one_minus_alphas_cumprod_t = sqrt_one_minus_alphas_cumprod[t]
-
-    # boardcasting into correct shape
-    sqrt_alphas_cumprod_t = sqrt_alphas_cumprod_t[:, None, None, None].to(
-        x_start.device)
-    sqrt_one_minus_alphas_cumprod_t = sqrt_one_minus_alphas_cumprod_t[:, None, None, None].to(
-        x_start.device)
+    # the schedule is a module buffer, so it is already on the device of x_start
+    # extract the value of \bar{\alpha} at time=t and boardcast into correct shape
+    # sqrt_one_minus_alphas is variance of the Gaussian N()
+    sqrt_alphas_cumprod_t, sqrt_one_minus_alphas_cumprod_t = gather_schedule(
+        t, sqrt_alphas_cumprod, sqrt_one_minus_alphas_cumprod)
 
     # scale down the input, and scale up the noise as time increases?
-    return sqrt_alphas_cumprod_t * x_start + sqrt_one_minus_alphas_cumprod_t * noise
+    return _q_sample_fused(x_start, noise, sqrt_alphas_cumprod_t, sqrt_one_minus_alphas_cumprod_t)
 
 
 def extract_x0(x_t, epsilon, t, sqrt_alphas_cumprod, sqrt_one_minus_alphas_cumprod):
@@ -71,18 +195,31 @@ def extract_x0(x_t, epsilon, t, sqrt_alphas_cumprod, sqrt_one_minus_alphas_cumpr
     t: timestep information
     """
     # sqrt_alphas is mean of the Gaussian N()
-    # extract the value of \bar{\alpha} at time=t
-    sqrt_alphas_cumprod_t = sqrt_alphas_cumprod[t]
-    # sqrt_alphas is variance of the Gaussian N()
-    sqrt_one_minus_alphas_cumprod_t = sqrt_one_minus_alphas_cumprod[t]
-
-    sqrt_alphas_cumprod_t = sqrt_alphas_cumprod_t[:, None, None, None].to(
-        x_t.device)
-    sqrt_one_minus_alphas_cumprod_t = sqrt_one_minus_alphas_cumprod_t[:, None, None, None].to(
-        x_t.device)
+    # extract the value of \bar{\alpha} at time=t and boardcast into correct shape
+    sqrt_alphas_cumprod_t, sqrt_one_minus_alphas_cumprod_t = gather_schedule(
+        t, sqrt_alphas_cumprod, sqrt_one_minus_alphas_cumprod)
 
     # obtaining x0 based on the inverse of eq.4 of DDPM paper
-    return (x_t - sqrt_one_minus_alphas_cumprod_t * epsilon) / sqrt_alphas_cumprod_t
+    return _extract_x0_fused(x_t, epsilon, sqrt_alphas_cumprod_t, sqrt_one_minus_alphas_cumprod_t)
+
+
+def cast_float(output):
+    # model outputs are either a tensor or a tuple of tensors (and None)
+    if isinstance(output, tuple):
+        return tuple(cast_float(i) for i in output)
+    if torch.is_tensor(output):
+        return output.float()
+    return output
+
+
+def trajectory_to_numpy(noise_list):
+    """
+    noise_list: list of tuple (x_t, t), ..., (x_0, 0) with the tensors still on device
+    Copies every step after the initial noise to host in a single transfer,
+    the initial noise is kept as a tensor.
+    """
+    steps = torch.stack([noise for noise, _ in noise_list[1:]]).cpu().numpy()
+    return noise_list[:1] + [(noise_npy, t_index) for noise_npy, (_, t_index) in zip(steps, noise_list[1:])]
 
 
 class RollDiffusion(pl.LightningModule):
@@ -91,32 +228,47 @@ class RollDiffusion(pl.LightningModule):
                  timesteps,
                  loss_type,
                  beta_start,
+                 compile_model=False,
+                 compile_mode="reduce-overhead",
+                 channels_last=False,
+                 bf16_sampling=False,
+                 save_intermediates=False,
                  ):
         super().__init__()
 
         self.save_hyperparameters()
+        # NHWC lets cuDNN pick its channels_last conv kernels for the (B, 1, T, F) rolls
+        self.memory_format = torch.channels_last if channels_last else torch.contiguous_format
 
         # define beta schedule
         # beta is variance
-        self.betas = linear_beta_schedule(timesteps=timesteps)
-
-        # define alphas
-        alphas = 1. - self.betas
-        alphas_cumprod = torch.cumprod(alphas, axis=0)
-        alphas_cumprod_prev = F.pad(alphas_cumprod[:-1], (1, 0), value=1.0)
-        self.sqrt_recip_alphas = torch.sqrt(1.0 / alphas)
-
-        # calculations for diffusion q(x_t | x_{t-1}) and others
-        self.sqrt_alphas_cumprod = torch.sqrt(alphas_cumprod)
-        self.sqrt_one_minus_alphas_cumprod = torch.sqrt(1. - alphas_cumprod)
-
-        # calculations for posterior q(x_{t-1} | x_t, x_0)
-        self.posterior_variance = self.betas * \
-            (1. - alphas_cumprod_prev) / (1. - alphas_cumprod)
+        # the schedule is registered as non-persistent buffers so that it follows
+        # the module to its device without being stored in the checkpoints
+        for name, tensor in make_schedule(linear_beta_schedule(
+                timesteps=timesteps)).items():
+            self.register_buffer(name, tensor, persistent=False)
+        # reverse diffusion order T-1, ..., 0 baked once instead of rebuilt per sample
+        self.register_buffer('t_schedule', torch.arange(
+            self.hparams.timesteps-1, -1, -1, dtype=torch.long), persistent=False)
+
+        self._t_buf = None
+        self._noise_buf = None
+        self._compiled_denoiser = None
+        if compile_model:
+            # compiled lazily on the first call, after the subclass has built its layers
+            self._compiled_denoiser = torch.compile(
+                self.forward, mode=compile_mode, dynamic=False, fullgraph=True)
+
+    def setup(self, stage=None):
+        # the layers are built by the subclass, so the weights are converted here
+        # rather than in __init__
+        if self.hparams.channels_last:
+            self.to(memory_format=torch.channels_last)
 
     def training_step(self, batch, batch_idx):
         batch_size = batch["frame"].shape[0]
-        batch = batch["frame"].unsqueeze(1)
+        batch = batch["frame"].unsqueeze(1).contiguous(
+            memory_format=self.memory_format)
         device = batch.device
         # Algorithm 1 line 3: sample t uniformally for every example in the batch
         t = torch.randint(0, self.hparams.timesteps,
@@ -130,7 +282,8 @@ class RollDiffusion(pl.LightningModule):
 
     def validation_step(self, batch, batch_idx):
         batch_size = batch["frame"].shape[0]
-        batch = batch["frame"].unsqueeze(1)
+        batch = batch["frame"].unsqueeze(1).contiguous(
+            memory_format=self.memory_format)
         device = batch.device
         # Algorithm 1 line 3: sample t uniformally for every example in the batch
         t = torch.randint(0, self.hparams.timesteps,
@@ -140,9 +293,11 @@ class RollDiffusion(pl.LightningModule):
                              self.sqrt_one_minus_alphas_cumprod, loss_type=self.hparams.loss_type)
         self.log("Val/loss", loss)
 
+    @torch.inference_mode()
     def test_step(self, batch, batch_idx):
         batch_size = batch["frame"].shape[0]
-        batch = batch["frame"].unsqueeze(1)
+        batch = batch["frame"].unsqueeze(1).contiguous(
+            memory_format=self.memory_format)
         device = batch.device
 
         # Algorithm 1 line 3: sample t uniformally for every example in the batch
@@ -153,33 +308,43 @@ class RollDiffusion(pl.LightningModule):
                              self.sqrt_one_minus_alphas_cumprod, loss_type=self.hparams.loss_type)
         self.log("Test/loss", loss)
 
+    @torch.inference_mode()
     def predict_step(self, batch, batch_idx):
         # inference code
         # Unwrapping TensorDataset (list)
         # It is a pure noise
-        img = batch[0]
+        img = batch[0].contiguous(memory_format=self.memory_format)
         b = img.shape[0]  # extracting batchsize
         device = img.device
         imgs = []
-        for i in tqdm(reversed(range(0, self.hparams.timesteps)), desc='sampling loop time step', total=self.hparams.timesteps):
+        # a single host copy of the schedule, the loop body then only launches kernels
+        t_schedule = self.t_schedule.tolist()
+        for i in tqdm(t_schedule, desc='sampling loop time step', miniters=10):
             img = self.p_sample(
                 img,
                 i)
-            img_npy = img.cpu().numpy()
+            # keep the trajectory on device, it is copied to host once after the loop
+            if self.keep_step(i):
+                imgs.append((img.detach(), i))
+        kept_t = [i for _, i in imgs]
+        imgs = list(torch.stack([img for img, _ in imgs]).cpu().numpy())
 
-            if (i+1) % 10 == 0:
-                for idx, j in enumerate(img_npy):
-                    # j (1, T, F)
-                    fig, ax = plt.subplots(1, 1)
-                    ax.imshow(j[0].T, aspect='auto', origin='lower')
-                    self.logger.experiment.add_figure(
-                        f"sample_{idx}",
-                        fig,
-                        global_step=self.hparams.timesteps-i)
-                    # self.hparams.timesteps-i is used because slide bar won't show
-                    # if global step starts from self.hparams.timesteps
-            imgs.append(img_npy)
-        torch.save(imgs, 'imgs.pt')
+        if batch_idx == 0:
+            for img_npy, i in zip(imgs, kept_t):
+                if (i+1) % 10 == 0:
+                    for idx, j in enumerate(img_npy):
+                        # j (1, T, F)
+                        fig, ax = plt.subplots(1, 1)
+                        ax.imshow(j[0].T, aspect='auto', origin='lower')
+                        self.logger.experiment.add_figure(
+                            f"sample_{idx}",
+                            fig,
+                            global_step=self.hparams.timesteps-i)
+                        # self.hparams.timesteps-i is used because slide bar won't show
+                        # if global step starts from self.hparams.timesteps
+                        plt.close()
+        if self.hparams.save_intermediates:
+            torch.save(imgs, 'imgs.pt')
 
     def p_losses(self, x_start, t, sqrt_alphas_cumprod, sqrt_one_minus_alphas_cumprod, noise=None, loss_type="l1"):
         if noise is None:
@@ -200,6 +365,41 @@ class RollDiffusion(pl.LightningModule):
 
         return loss
 
+    def denoise(self, *args, **kwargs):
+        # forward pass used inside the sampling loop
+        denoiser = self if self._compiled_denoiser is None else self._compiled_denoiser
+        if not self.hparams.bf16_sampling:
+            return denoiser(*args, **kwargs)
+
+        with torch.autocast(device_type=self.device.type, dtype=torch.bfloat16):
+            output = denoiser(*args, **kwargs)
+        # casting the prediction back so that the schedule math stays in fp32
+        return cast_float(output)
+
+    def t_tensor(self, x, t_index):
+        # boardcasting t_index into a reusable device tensor
+        # (avoids a host->device copy per step and keeps the graph capturable)
+        # the buffer only grows, a smaller last batch takes a view of it
+        if self._t_buf is None or self._t_buf.shape[0] < x.shape[0] or self._t_buf.device != x.device:
+            self._t_buf = torch.empty(
+                x.shape[0], dtype=torch.long, device=x.device)
+        return self._t_buf[:x.shape[0]].fill_(t_index)
+
+    def noise_like(self, x):
+        # in-place normal_() into a reused buffer instead of a fresh randn_like per step
+        if self._noise_buf is None or self._noise_buf.shape != x.shape or \
+                self._noise_buf.device != x.device or self._noise_buf.dtype != x.dtype:
+            self._noise_buf = torch.empty_like(x)
+        return self._noise_buf.normal_()
+
+    def keep_step(self, t_index):
+        # the whole trajectory is only kept when it is saved to disk,
+        # otherwise ~40 snapshots (and x_0) are enough for the figures
+        if self.hparams.save_intermediates or t_index == 0:
+            return True
+        keep_every = max(1, self.hparams.timesteps // 40)
+        return (t_index+1) % keep_every == 0
+
     def p_sample(self, x, t_index):
         # x is Guassian noise
 
@@ -208,13 +408,12 @@ class RollDiffusion(pl.LightningModule):
         sqrt_one_minus_alphas_cumprod_t = self.sqrt_one_minus_alphas_cumprod[t_index]
         sqrt_recip_alphas_t = self.sqrt_recip_alphas[t_index]
 
-        # boardcasting t_index into a tensor
-        t_tensor = torch.tensor(t_index).repeat(x.shape[0]).to(x.device)
+        t_tensor = self.t_tensor(x, t_index)
 
         # Equation 11 in the paper
         # Use our model (noise predictor) to predict the mean
         model_mean = sqrt_recip_alphas_t * (
-            x - betas_t * self(x, t_tensor) / sqrt_one_minus_alphas_cumprod_t
+            x - betas_t * self.denoise(x, t_tensor) / sqrt_one_minus_alphas_cumprod_t
         )
 
         if t_index == 0:
@@ -222,7 +421,7 @@ class RollDiffusion(pl.LightningModule):
         else:
             # posterior_variance_t = extract(self.posterior_variance, t, x.shape)
             posterior_variance_t = self.posterior_variance[t_index]
-            noise = torch.randn_like(x)
+            noise = self.noise_like(x)
             # Algorithm 2 line 4:
             return model_mean + torch.sqrt(posterior_variance_t) * noise
 
@@ -251,7 +450,13 @@ class SpecRollDiffusion(pl.LightningModule):
                  training,
                  sampling,
                  debug=False,
-                 generation_filter=0.0
+                 generation_filter=0.0,
+                 compile_model=False,
+                 compile_mode="reduce-overhead",
+                 bf16_sampling=False,
+                 inference_quant="none",
+                 save_intermediates=False,
+                 sampling_steps=None,
                  ):
         super().__init__()
 
@@ -261,26 +466,93 @@ class SpecRollDiffusion(pl.LightningModule):
         # beta is variance
         # self.betas = linear_beta_schedule(
         #     beta_start, beta_end, timesteps=timesteps)
-        self.betas = cosine_beta_schedule(timesteps)
-
-        # define alphas
-        alphas = 1. - self.betas
-        alphas_cumprod = torch.cumprod(alphas, axis=0)
-        alphas_cumprod_prev = F.pad(alphas_cumprod[:-1], (1, 0), value=1.0)
-        self.sqrt_recip_alphas = torch.sqrt(1.0 / alphas)
-
-        # calculations for diffusion q(x_t | x_{t-1}) and others
-        self.sqrt_alphas_cumprod = torch.sqrt(alphas_cumprod)
-        self.sqrt_one_minus_alphas_cumprod = torch.sqrt(1. - alphas_cumprod)
-
-        # calculations for posterior q(x_{t-1} | x_t, x_0)
-        self.posterior_variance = self.betas * \
-            (1. - alphas_cumprod_prev) / (1 - alphas_cumprod)
         self.inner_loop = tqdm(range(self.hparams.timesteps),
                                desc='sampling loop time step')
 
         self.reverse_diffusion = getattr(self, sampling.type)
-        self.alphas = alphas
+        # training objective resolved once instead of branching on every batch
+        if training.mode not in ['epsilon', 'x_0', 'ex_0']:
+            raise ValueError(
+                f"training mode {training.mode} is not supported. Please either use 'x_0', 'ex_0' or 'epsilon'.")
+        self.objective_step = getattr(self, f"{training.mode}_step")
+        # reverse diffusion order T-1, ..., 0 baked once instead of rebuilt per sample
+        if sampling_steps:
+            # strided schedule, only valid for the deterministic DDIM updates
+            if sampling.type not in ['ddim', 'ddim_x0', 'cfdg_ddim_x0']:
+                raise ValueError(
+                    f"sampling_steps requires a ddim sampler, got '{sampling.type}'")
+            t_schedule = torch.linspace(
+                timesteps-1, 0, min(sampling_steps, timesteps)).round().long()
+        else:
+            t_schedule = torch.arange(timesteps-1, -1, -1, dtype=torch.long)
+        self.register_buffer('t_schedule', t_schedule, persistent=False)
+        t_list = t_schedule.tolist()
+        # previous timestep of each step in the schedule, -1 after x_0
+        self.prev_t = dict(zip(t_list, t_list[1:] + [-1]))
+        prev_t = torch.arange(timesteps) - 1
+        prev_t[t_schedule] = torch.tensor(t_list[1:] + [-1])
+        # the schedule is registered as non-persistent buffers so that it follows
+        # the module to its device without being stored in the checkpoints
+        for name, tensor in make_schedule(cosine_beta_schedule(timesteps), prev_t).items():
+            self.register_buffer(name, tensor, persistent=False)
+        self.kept_t = set(t_list[::max(1, len(t_list) // 40)] + [0])
+
+        self._t_buf = None
+        self._noise_buf = None
+        self._quantized = False
+        self._io_pool = None
+        self._io_futures = []
+        self._compiled_denoiser = None
+        if compile_model:
+            # compiled lazily on the first call, after the subclass has built its layers.
+            # Not fullgraph: the subclasses run torchaudio's mel_layer inside forward, which
+            # calls torch.jit.isinstance and always graph breaks
+            self._compiled_denoiser = torch.compile(
+                self.forward, mode=compile_mode, dynamic=False)
+
+    def on_test_start(self):
+        self.quantize_weights()
+
+    def on_predict_start(self):
+        self.quantize_weights()
+
+    def on_test_end(self):
+        self.wait_io()
+
+    def on_predict_end(self):
+        self.wait_io()
+
+    def submit_io(self, fn, *args, **kwargs):
+        # audio/midi files are written on a small thread pool so that the writes
+        # overlap with the evaluation of the next samples
+        if self._io_pool is None:
+            self._io_pool = ThreadPoolExecutor(max_workers=4)
+        self._io_futures.append(self._io_pool.submit(fn, *args, **kwargs))
+
+    def wait_io(self):
+        # result() re-raises any exception from the writes
+        for future in self._io_futures:
+            future.result()
+        self._io_futures = []
+        if self._io_pool is not None:
+            self._io_pool.shutdown()
+            self._io_pool = None
+
+    def quantize_weights(self):
+        # weight-only quantization of the Linear layers for the inference-only paths,
+        # the weights are replaced in place so the module should not be trained afterwards
+        if self.hparams.inference_quant == "none" or self._quantized:
+            return
+        from torchao.quantization import quantize_, Int8WeightOnlyConfig, Int4WeightOnlyConfig
+        if self.hparams.inference_quant == "int8":
+            config = Int8WeightOnlyConfig()
+        elif self.hparams.inference_quant == "int4":
+            config = Int4WeightOnlyConfig()
+        else:
+            raise ValueError(
+                f"unrecognized inference_quant '{self.hparams.inference_quant}'")
+        quantize_(self, config)
+        self._quantized = True
 
     def training_step(self, batch, batch_idx):
         losses, tensors = self.step(batch)
@@ -300,10 +572,11 @@ class SpecRollDiffusion(pl.LightningModule):
         total_loss = 0
         for k in self.hparams.loss_keys:
             total_loss += losses[k]
-            self.log(f"Val/{k}", losses[k])
+            # averaged over ranks, Val/diffusion_loss is monitored for checkpointing
+            self.log(f"Val/{k}", losses[k], sync_dist=True)
         # self.log("Val/amt_loss", losses['amt_loss'])
 
-        if batch_idx == 0:
+        if batch_idx == 0 and self.trainer.is_global_zero:
             self.visualize_figure(
                 tensors['pred_roll'], 'Val/pred_roll', batch_idx)
 
@@ -342,6 +615,7 @@ class SpecRollDiffusion(pl.LightningModule):
                     self.visualize_figure(
                         tensors['label_roll2'], 'Val/label_roll2', batch_idx)
 
+    @torch.inference_mode()
     def test_step(self, batch, batch_idx):
         noise_list, spec = self.sampling(batch, batch_idx)
 
@@ -349,44 +623,24 @@ class SpecRollDiffusion(pl.LightningModule):
         roll_pred = noise_list[-1][0]  # (B, 1, T, F)
         roll_label = batch["frame"].unsqueeze(1).cpu()
 
-        if batch_idx == 0:
+        # only rank 0 writes the debug files and figures
+        if batch_idx == 0 and self.trainer.is_global_zero:
             torch.save(spec, 'spec.pt')
             self.visualize_figure(spec.transpose(-1, -2).unsqueeze(1),
                                   'Test/spec',
                                   batch_idx)
             for noise_npy, t_index in noise_list:
-                if (t_index+1) % 10 == 0:
-                    fig, ax = plt.subplots(2, 2)
-                    for idx, j in enumerate(noise_npy):
-                        # j (1, T, F)
-                        ax.flatten()[idx].imshow(
-                            j[0].T, aspect='auto', origin='lower')
-                        self.logger.experiment.add_figure(
-                            f"Test/pred",
-                            fig,
-                            global_step=self.hparams.timesteps-t_index)
-                        plt.close()
+                # kept_t follows the sampling schedule, so strided schedules still log ~40 grids
+                if t_index in self.kept_t:
+                    self.visualize_grid(noise_npy, 'Test/pred',
+                                        self.hparams.timesteps-t_index)
 
-            fig1, ax1 = plt.subplots(2, 2)
-            fig2, ax2 = plt.subplots(2, 2)
-            for idx in range(4):
+            self.visualize_grid(roll_label, 'Test/label', 0)
+            self.visualize_grid(
+                roll_pred > self.hparams.frame_threshold, 'Test/pred_roll', 0)
 
-                ax1.flatten()[idx].imshow(roll_label[idx][0].T,
-                                          aspect='auto', origin='lower')
-                self.logger.experiment.add_figure(
-                    f"Test/label",
-                    fig1,
-                    global_step=0)
-
-                ax2.flatten()[idx].imshow(
-                    (roll_pred[idx][0] > self.hparams.frame_threshold).T, aspect='auto', origin='lower')
-                self.logger.experiment.add_figure(
-                    f"Test/pred_roll",
-                    fig2,
-                    global_step=0)
-                plt.close()
-
-            torch.save(noise_list, 'noise_list.pt')
+            if self.hparams.save_intermediates:
+                torch.save(noise_list, 'noise_list.pt')
 
             # ======== Begins animation ===========
             # t_list = torch.arange(1, self.hparams.timesteps, 5).flip(0)
@@ -420,9 +674,8 @@ class SpecRollDiffusion(pl.LightningModule):
         print(roll_pred.min())
         print(roll_pred.max())
         print(self.hparams.frame_threshold)
-        frame_p, frame_r, frame_f1, _ = precision_recall_fscore_support(roll_label.flatten(),
-                                                                        roll_pred.flatten() > self.hparams.frame_threshold,
-                                                                        average='binary')
+        frame_p, frame_r, frame_f1 = frame_precision_recall_f1(roll_label,
+                                                               roll_pred > self.hparams.frame_threshold)
         print((roll_pred.flatten() > self.hparams.frame_threshold).sum())
         print(roll_label.flatten().sum())
         print(frame_f1)
@@ -448,28 +701,28 @@ class SpecRollDiffusion(pl.LightningModule):
 
             # Converting time steps to seconds and midi number to frequency
             i_ref = (i_ref * scaling).reshape(-1, 2)
-            p_ref = np.array([midi_to_hz(MIN_MIDI + midi) for midi in p_ref])
+            p_ref = midi_to_hz(MIN_MIDI + p_ref)
             i_est = (i_est * scaling).reshape(-1, 2)
-            p_est = np.array([midi_to_hz(MIN_MIDI + midi) for midi in p_est])
+            p_est = midi_to_hz(MIN_MIDI + p_est)
 
             p, r, f, o = evaluate_notes(
                 i_ref, p_ref, i_est, p_est, offset_ratio=None)
 
             if batch_idx == 0:
-                torchaudio.save(f'audio_{sample_idx}.mp3',
-                                batch['audio'][sample_idx].unsqueeze(0).cpu(),
-                                sample_rate=self.hparams.spec_args.sample_rate)
+                self.submit_io(torchaudio.save, f'audio_{sample_idx}.mp3',
+                               batch['audio'][sample_idx].unsqueeze(0).cpu(),
+                               sample_rate=self.hparams.spec_args.sample_rate)
                 clean_notes = (i_est[:, 1]-i_est[:, 0]
                                ) > self.hparams.generation_filter
 
-                save_midi(os.path.join('./', f'clean_midi_{sample_idx}.mid'),
-                          p_est[clean_notes],
-                          i_est[clean_notes],
-                          [127]*len(p_est))
-                save_midi(os.path.join('./', f'raw_midi_{sample_idx}.mid'),
-                          p_est,
-                          i_est,
-                          [127]*len(p_est))
+                self.submit_io(save_midi, os.path.join('./', f'clean_midi_{sample_idx}.mid'),
+                               p_est[clean_notes],
+                               i_est[clean_notes],
+                               [127]*len(p_est))
+                self.submit_io(save_midi, os.path.join('./', f'raw_midi_{sample_idx}.mid'),
+                               p_est,
+                               i_est,
+                               [127]*len(p_est))
 
                 self.log("Test/Note_F1", f)
             print("Test/Note_F1", f)
@@ -558,6 +811,7 @@ class SpecRollDiffusion(pl.LightningModule):
 #             self.log("Test/Note_F1", f)
 #         self.log("Test/Frame_F1", frame_f1)
 
+    @torch.inference_mode()
     def predict_step(self, batch, batch_idx):
         noise = batch[0]
         waveform = batch[1]
@@ -567,20 +821,24 @@ class SpecRollDiffusion(pl.LightningModule):
         device = noise.device
         # Algorithm 1 line 3: sample t uniformally for every example in the batch
 
-        self.inner_loop.refresh()
+        # reset() also redraws the bar
         self.inner_loop.reset()
 
         noise_list = []
         noise_list.append((noise, self.hparams.timesteps))
 
-        for t_index in reversed(range(0, self.hparams.timesteps)):
+        t_schedule = self.t_schedule.tolist()
+        for i, t_index in enumerate(t_schedule):
             noise, spec = self.reverse_diffusion(noise, waveform, t_index)
-            noise_npy = noise.detach().cpu().numpy()
             # self.hparams.timesteps-i is used because slide bar won't show
             # if global step starts from self.hparams.timesteps
-            noise_list.append((noise_npy, t_index))
-            self.inner_loop.update()
-            # ======== Animation saved ===========
+            if self.keep_step(t_index):
+                noise_list.append((noise.detach(), t_index))
+            # refreshing the bar every step stalls the kernel launches
+            if (i+1) % 10 == 0:
+                self.inner_loop.update(10)
+        self.inner_loop.update(len(t_schedule) % 10)
+        noise_list = trajectory_to_numpy(noise_list)
 
         # noise_list is a list of tuple (pred_t, t), ..., (pred_0, 0)
         roll_pred = noise_list[-1][0]  # (B, 1, T, F)
@@ -590,42 +848,24 @@ class SpecRollDiffusion(pl.LightningModule):
                                   'Test/spec',
                                   batch_idx)
             for noise_npy, t_index in noise_list:
-                if (t_index+1) % 10 == 0:
-                    fig, ax = plt.subplots(2, 2)
-                    for idx, j in enumerate(noise_npy):
-                        if idx < 4:
-                            # j (1, T, F)
-                            ax.flatten()[idx].imshow(
-                                j[0].T, aspect='auto', origin='lower')
-                            self.logger.experiment.add_figure(
-                                f"Test/pred",
-                                fig,
-                                global_step=self.hparams.timesteps-t_index)
-                            plt.close()
-                        else:
-                            break
-
-            fig1, ax1 = plt.subplots(2, 2)
-            fig2, ax2 = plt.subplots(2, 2)
-            for idx, roll_pred_i in enumerate(roll_pred):
-
-                ax2.flatten()[idx].imshow(
-                    (roll_pred_i[0] > self.hparams.frame_threshold).T, aspect='auto', origin='lower')
-                self.logger.experiment.add_figure(
-                    f"Test/pred_roll",
-                    fig2,
-                    global_step=0)
-                plt.close()
-
-            torch.save(noise_list, 'noise_list.pt')
+                # kept_t follows the sampling schedule, so strided schedules still log ~40 grids
+                if t_index in self.kept_t:
+                    self.visualize_grid(noise_npy, 'Test/pred',
+                                        self.hparams.timesteps-t_index)
+
+            self.visualize_grid(
+                roll_pred > self.hparams.frame_threshold, 'Test/pred_roll', 0)
+
+        if batch_idx == 0:
+            if self.hparams.save_intermediates:
+                torch.save(noise_list, 'noise_list.pt')
             # torch.save(spec, 'spec.pt')
             # torch.save(roll_label, 'roll_label.pt')
 
             # ======== Begins animation ===========
-            t_list = torch.arange(1, self.hparams.timesteps, 5).flip(0)
-            if t_list[-1] != self.hparams.timesteps:
-                t_list = torch.cat(
-                    (t_list, torch.tensor([self.hparams.timesteps])), 0)
+            # one frame per kept snapshot, looked up by t since the trajectory can be subsampled
+            x_by_t = {t_index: noise_npy for noise_npy, t_index in noise_list}
+            t_list = sorted(self.kept_t, reverse=True)
             ims = []
             fig, axes = plt.subplots(2, 4, figsize=(16, 5))
 
@@ -641,7 +881,7 @@ class SpecRollDiffusion(pl.LightningModule):
                                           frames=tqdm(
                                               t_list, desc='Animating'),
                                           fargs=(fig, ax_flat, caxs,
-                                                 noise_list, ),
+                                                 x_by_t, ),
                                           interval=500,
                                           blit=False,
                                           repeat_delay=1000)
@@ -649,27 +889,13 @@ class SpecRollDiffusion(pl.LightningModule):
             # ======== Animation saved ===========
 
         # export as midi
+        # note extraction and the writes of every roll run on the I/O pool
         for roll_idx, np_frame in enumerate(noise_list[-1][0]):
             # np_frame = (1, T, 88)
-            np_frame = np_frame[0]
-            p_est, i_est = extract_notes_wo_velocity(np_frame, np_frame)
-
-            scaling = HOP_LENGTH / SAMPLE_RATE
-            # Converting time steps to seconds and midi number to frequency
-            i_est = (i_est * scaling).reshape(-1, 2)
-            p_est = np.array([midi_to_hz(MIN_MIDI + midi) for midi in p_est])
-
-            clean_notes = (i_est[:, 1]-i_est[:, 0]
-                           ) > self.hparams.generation_filter
-
-            save_midi(os.path.join('./', f'clean_midi_e{batch_idx}_{roll_idx}.mid'),
-                      p_est[clean_notes],
-                      i_est[clean_notes],
-                      [127]*len(p_est))
-            save_midi(os.path.join('./', f'raw_midi_{batch_idx}_{roll_idx}.mid'),
-                      p_est,
-                      i_est,
-                      [127]*len(p_est))
+            self.submit_io(export_midi, np_frame[0], HOP_LENGTH / SAMPLE_RATE,
+                           self.hparams.generation_filter,
+                           os.path.join('./', f'clean_midi_e{batch_idx}_{roll_idx}.mid'),
+                           os.path.join('./', f'raw_midi_{batch_idx}_{roll_idx}.mid'))
 
 #         # uncomment this part if you want to save ground truth midi
 #         for roll_idx, np_frame in enumerate(roll_label.unsqueeze(1).cpu().numpy()):
@@ -690,17 +916,29 @@ class SpecRollDiffusion(pl.LightningModule):
 #                       [127]*len(p_est))
 
     def visualize_figure(self, tensors, tag, batch_idx):
+        # only rank 0 logs, the other ranks skip the device->host copy
+        if not self.trainer.is_global_zero:
+            return
         fig, ax = plt.subplots(2, 2)
-        for idx, tensor in enumerate(tensors):  # visualize only 4 piano rolls
-            # roll_pred (1, T, F)
-            if (idx >= ax.flatten().size):
-                break
-            ax.flatten()[idx].imshow(tensor[0].T.cpu(),
-                                     aspect='auto', origin='lower')
+        flat_ax = ax.flatten()
+        # visualize only 4 piano rolls, copied to host in a single transfer
+        rolls = tensors[:flat_ax.size, 0].detach().transpose(-1, -2).cpu()
+        for axis, roll in zip(flat_ax, rolls):
+            # roll (F, T)
+            axis.imshow(roll, aspect='auto', origin='lower')
         self.logger.experiment.add_figure(
             f"{tag}", fig, global_step=self.current_epoch)
         plt.close()
 
+    def visualize_grid(self, tensors, tag, global_step):
+        # tiling the first 4 piano rolls (B, 1, T, F) into one image,
+        # a single add_image instead of a matplotlib figure per roll
+        rolls = torch.as_tensor(tensors[:4]).float()
+        # (b, 1, F, T) with the lowest pitch at the bottom, like origin='lower'
+        rolls = rolls.transpose(-1, -2).flip(-2)
+        grid = make_grid(rolls, nrow=2, normalize=True, pad_value=1)
+        self.logger.experiment.add_image(tag, grid, global_step=global_step)
+
     def step(self, batch):
         # batch["frame"] (B, 640, 88)
         # batch["audio"] (B, L)
@@ -727,66 +965,35 @@ class SpecRollDiffusion(pl.LightningModule):
 
         noise = torch.randn_like(roll)  # creating label noise
 
-        x_t = q_sample(  # sampling noise at time t
-            x_start=roll,
-            t=t,
-            sqrt_alphas_cumprod=self.sqrt_alphas_cumprod,
-            sqrt_one_minus_alphas_cumprod=self.sqrt_one_minus_alphas_cumprod,
-            noise=noise)
-
-        # When debugging model is use, change waveform into roll
-        if self.hparams.training.mode == 'epsilon':
-            if self.hparams.debug == True:
-                # predict the noise N(0, 1)
-                epsilon_pred, spec = self(x_t, roll, t)
-            else:
-                # predict the noise N(0, 1)
-                epsilon_pred, spec = self(x_t, waveform, t)
-            diffusion_loss = self.p_losses(
-                noise, epsilon_pred, loss_type=self.hparams.loss_type)
-
-            pred_roll = extract_x0(
-                x_t,
-                epsilon_pred,
-                t,
-                sqrt_alphas_cumprod=self.sqrt_alphas_cumprod,
-                sqrt_one_minus_alphas_cumprod=self.sqrt_one_minus_alphas_cumprod)
-
-        elif self.hparams.training.mode == 'x_0':
-            # predict the noise N(0, 1)
-            pred_roll, spec = self(x_t, waveform, t)
-            diffusion_loss = self.p_losses(
-                roll, pred_roll, loss_type=self.hparams.loss_type)
-            if isinstance(batch, list):  # when using multiple dataset do one more feedforward
-
-                x_t2 = q_sample(  # sampling noise at time t
-                    x_start=roll2,
-                    t=t,
-                    sqrt_alphas_cumprod=self.sqrt_alphas_cumprod,
-                    sqrt_one_minus_alphas_cumprod=self.sqrt_one_minus_alphas_cumprod,
-                    noise=noise)
-                pred_roll2, spec2 = self(
-                    x_t2, waveform2, t, sampling=True)  # sampling = True
-                # line 656 of diffwav.py will be activated and the second dataset would be always p=-1
-                # i.e. the spectrograms are always -1
+        # coefficients at t gathered once and shared by q_sample and extract_x0
+        schedule_t = gather_schedule(
+            t, self.sqrt_alphas_cumprod, self.sqrt_one_minus_alphas_cumprod)
+        # sampling noise at time t
+        x_t = _q_sample_fused(roll, noise, *schedule_t)
+
+        diffusion_loss, pred_roll, spec = self.objective_step(
+            roll, waveform, x_t, t, noise, schedule_t)
+
+        if isinstance(batch, list):  # when using multiple dataset do one more feedforward
+            # sampling noise at time t
+            x_t2 = _q_sample_fused(roll2, noise, *schedule_t)
+            prediction2, spec2 = self(
+                x_t2, waveform2, t, sampling=True)  # sampling = True
+            # line 656 of diffwav.py will be activated and the second dataset would be always p=-1
+            # i.e. the spectrograms are always -1
+            # the loss follows the parameterisation of the training mode, like objective_step
+            if self.hparams.training.mode == 'x_0':
+                pred_roll2 = prediction2
+                unconditional_diffusion_loss = self.p_losses(
+                    roll2, pred_roll2, loss_type=self.hparams.loss_type)
+            elif self.hparams.training.mode == 'epsilon':
+                unconditional_diffusion_loss = self.p_losses(
+                    noise, prediction2, loss_type=self.hparams.loss_type)
+                pred_roll2 = _extract_x0_fused(x_t2, prediction2.detach(), *schedule_t)
+            else:  # ex_0
+                pred_roll2 = _extract_x0_fused(x_t2, prediction2, *schedule_t)
                 unconditional_diffusion_loss = self.p_losses(
                     roll2, pred_roll2, loss_type=self.hparams.loss_type)
-
-        elif self.hparams.training.mode == 'ex_0':
-            # predict the noise N(0, 1)
-            epsilon_pred, spec = self(x_t, waveform, t)
-            pred_roll = extract_x0(
-                x_t,
-                epsilon_pred,
-                t,
-                sqrt_alphas_cumprod=self.sqrt_alphas_cumprod,
-                sqrt_one_minus_alphas_cumprod=self.sqrt_one_minus_alphas_cumprod)
-            diffusion_loss = self.p_losses(
-                roll, pred_roll, loss_type=self.hparams.loss_type)
-
-        else:
-            raise ValueError(
-                f"training mode {self.training.mode} is not supported. Please either use 'x_0' or 'epsilon'.")
 
         # pred_roll = torch.sigmoid(pred_roll) # to convert logit into probability
         # amt_loss = F.binary_cross_entropy(pred_roll, roll)
@@ -820,6 +1027,7 @@ class SpecRollDiffusion(pl.LightningModule):
 
         return losses, tensors
 
+    @torch.inference_mode()
     def sampling(self, batch, batch_idx):
         batch_size = batch["frame"].shape[0]
         roll = self.normalize(batch["frame"]).unsqueeze(1)
@@ -827,7 +1035,7 @@ class SpecRollDiffusion(pl.LightningModule):
         device = roll.device
         # Algorithm 1 line 3: sample t uniformally for every example in the batch
 
-        self.inner_loop.refresh()
+        # reset() also redraws the bar
         self.inner_loop.reset()
 
         # noise = torch.randn_like(roll)
@@ -838,7 +1046,8 @@ class SpecRollDiffusion(pl.LightningModule):
         noise = torch.randn_like(roll)
         batch_size = batch["frame"].shape[0]
         fixed_t = 175
-        t = torch.full((batch_size,), fixed_t-1, device=roll.device).long()
+        t = torch.full((batch_size,), fixed_t-1,
+                       dtype=torch.long, device=roll.device)
         x_t = q_sample(
             x_start=roll,
             t=t,
@@ -851,18 +1060,48 @@ class SpecRollDiffusion(pl.LightningModule):
         # ------- DEBUG-------
 
         # for t_index in reversed(range(0, self.hparams.timesteps)):
-        for t_index in reversed(range(0, fixed_t)):
+        t_schedule = self.t_schedule[self.t_schedule < fixed_t].tolist()
+        for i, t_index in enumerate(t_schedule):
             if self.hparams.debug == True:
                 noise, spec = self.reverse_diffusion(noise, roll, t_index)
             else:
                 noise, spec = self.reverse_diffusion(noise, waveform, t_index)
-            noise_npy = noise.detach().cpu().numpy()
             # self.hparams.timesteps-i is used because slide bar won't show
             # if global step starts from self.hparams.timesteps
-            noise_list.append((noise_npy, t_index))
-            self.inner_loop.update()
+            if self.keep_step(t_index):
+                noise_list.append((noise.detach(), t_index))
+            if (i+1) % 10 == 0:
+                self.inner_loop.update(10)
+        self.inner_loop.update(len(t_schedule) % 10)
+
+        return trajectory_to_numpy(noise_list), spec
 
-        return noise_list, spec
+    def epsilon_step(self, roll, waveform, x_t, t, noise, schedule_t):
+        # When debugging model is use, change waveform into roll
+        condition = roll if self.hparams.debug == True else waveform
+        # predict the noise N(0, 1)
+        epsilon_pred, spec = self(x_t, condition, t)
+        diffusion_loss = self.p_losses(
+            noise, epsilon_pred, loss_type=self.hparams.loss_type)
+
+        # the implied x_0 is only logged, so it is kept out of the autograd graph
+        pred_roll = _extract_x0_fused(x_t, epsilon_pred.detach(), *schedule_t)
+        return diffusion_loss, pred_roll, spec
+
+    def x_0_step(self, roll, waveform, x_t, t, noise, schedule_t):
+        # predict x_0 directly
+        pred_roll, spec = self(x_t, waveform, t)
+        diffusion_loss = self.p_losses(
+            roll, pred_roll, loss_type=self.hparams.loss_type)
+        return diffusion_loss, pred_roll, spec
+
+    def ex_0_step(self, roll, waveform, x_t, t, noise, schedule_t):
+        # predict the noise N(0, 1), but the loss is taken on the implied x_0
+        epsilon_pred, spec = self(x_t, waveform, t)
+        pred_roll = _extract_x0_fused(x_t, epsilon_pred, *schedule_t)
+        diffusion_loss = self.p_losses(
+            roll, pred_roll, loss_type=self.hparams.loss_type)
+        return diffusion_loss, pred_roll, spec
 
     def p_losses(self, label, prediction, loss_type="l1"):
         if loss_type == 'l1':
@@ -876,114 +1115,128 @@ class SpecRollDiffusion(pl.LightningModule):
 
         return loss
 
+    def denoise(self, *args, **kwargs):
+        # forward pass used inside the sampling loop
+        denoiser = self if self._compiled_denoiser is None else self._compiled_denoiser
+        if not self.hparams.bf16_sampling:
+            return denoiser(*args, **kwargs)
+
+        with torch.autocast(device_type=self.device.type, dtype=torch.bfloat16):
+            output = denoiser(*args, **kwargs)
+        # casting the prediction back so that the schedule math stays in fp32
+        return cast_float(output)
+
+    def t_tensor(self, x, t_index):
+        # boardcasting t_index into a reusable device tensor
+        # (avoids a host->device copy per step and keeps the graph capturable)
+        # the buffer only grows, a smaller last batch takes a view of it
+        if self._t_buf is None or self._t_buf.shape[0] < x.shape[0] or self._t_buf.device != x.device:
+            self._t_buf = torch.empty(
+                x.shape[0], dtype=torch.long, device=x.device)
+        return self._t_buf[:x.shape[0]].fill_(t_index)
+
+    def noise_like(self, x):
+        # in-place normal_() into a reused buffer instead of a fresh randn_like per step
+        if self._noise_buf is None or self._noise_buf.shape != x.shape or \
+                self._noise_buf.device != x.device or self._noise_buf.dtype != x.dtype:
+            self._noise_buf = torch.empty_like(x)
+        return self._noise_buf.normal_()
+
+    def keep_step(self, t_index):
+        # the whole trajectory is only kept when it is saved to disk,
+        # otherwise ~40 snapshots (and x_0) are enough for the figures
+        return self.hparams.save_intermediates or t_index in self.kept_t
+
     def ddpm(self, x, waveform, t_index):
         # x is Guassian noise
 
-        # extracting coefficients at time t
-        betas_t = self.betas[t_index]
-        sqrt_one_minus_alphas_cumprod_t = self.sqrt_one_minus_alphas_cumprod[t_index]
-        sqrt_recip_alphas_t = self.sqrt_recip_alphas[t_index]
-
-        # boardcasting t_index into a tensor
-        t_tensor = torch.tensor(t_index).repeat(x.shape[0]).to(x.device)
+        t_tensor = self.t_tensor(x, t_index)
 
         # Equation 11 in the paper
         # Use our model (noise predictor) to predict the mean
-        epsilon, spec = self(x, waveform, t_tensor)
+        epsilon, spec = self.denoise(x, waveform, t_tensor)
 
-        model_mean = sqrt_recip_alphas_t * (
-            x - betas_t * epsilon / sqrt_one_minus_alphas_cumprod_t
-        )
+        # coefficients precomputed in make_schedule, one fused kernel per step
         if t_index == 0:
-            return model_mean, spec
-        else:
-            # posterior_variance_t = extract(self.posterior_variance, t, x.shape)
-            posterior_variance_t = self.posterior_variance[t_index]
-            noise = torch.randn_like(x)
-            # Algorithm 2 line 4:
-            return (model_mean + torch.sqrt(posterior_variance_t) * noise), spec
+            return _x0_step_fused(x, epsilon, self.ddpm_eps_coef_eps[t_index],
+                                  self.ddpm_eps_coef_xt[t_index]), spec
+        # Algorithm 2 line 4:
+        return _x0_noisy_step_fused(x, epsilon, self.noise_like(x),
+                                    self.ddpm_eps_coef_eps[t_index],
+                                    self.ddpm_eps_coef_xt[t_index],
+                                    self.ddpm_x0_sigma[t_index]), spec
+
+    def x0_posterior(self, x, x0_pred, t_index):
+        # ddpm posterior step from an x0 prediction as one fused elementwise kernel,
+        # no noise is added on the last step
+        if t_index == 0:
+            return _x0_step_fused(x, x0_pred, self.ddpm_x0_coef_x0[t_index],
+                                  self.ddpm_x0_coef_xt[t_index])
+        return _x0_noisy_step_fused(x, x0_pred, self.noise_like(x),
+                                    self.ddpm_x0_coef_x0[t_index],
+                                    self.ddpm_x0_coef_xt[t_index],
+                                    self.ddpm_x0_sigma[t_index])
 
     def ddpm_x0(self, x, waveform, t_index):
         # x is x_t, when t=T it is pure Gaussian
 
-        # boardcasting t_index into a tensor
-        t_tensor = torch.tensor(t_index).repeat(x.shape[0]).to(x.device)
+        t_tensor = self.t_tensor(x, t_index)
 
         # Equation 11 in the paper
         # Use our model (noise predictor) to predict the mean
-        x0_pred, spec = self(x, waveform, t_tensor)
+        x0_pred, spec = self.denoise(x, waveform, t_tensor)
 
-        if t_index == 0:
-            sigma = (1/self.sqrt_one_minus_alphas_cumprod[t_index]) * (
-                torch.sqrt(1-self.alphas[t_index]))
-            model_mean = x0_pred / self.sqrt_alphas_cumprod[t_index]
-        else:
-            sigma = (self.sqrt_one_minus_alphas_cumprod[t_index-1]/self.sqrt_one_minus_alphas_cumprod[t_index]) * (
-                torch.sqrt(1-self.alphas[t_index]))
-            model_mean = (self.sqrt_alphas_cumprod[t_index-1]) * x0_pred + (
-                torch.sqrt(1 - self.sqrt_alphas_cumprod[t_index-1]**2 - sigma**2) * (
-                    x-self.sqrt_alphas_cumprod[t_index] * x0_pred)/self.sqrt_one_minus_alphas_cumprod[t_index]) + (
-                sigma * torch.randn_like(x))
+        model_mean = self.x0_posterior(x, x0_pred, t_index)
 
         return model_mean, spec
 
     def ddim_x0(self, x, waveform, t_index):
         # x is x_t, when t=T it is pure Gaussian
 
-        # boardcasting t_index into a tensor
-        t_tensor = torch.tensor(t_index).repeat(x.shape[0]).to(x.device)
+        t_tensor = self.t_tensor(x, t_index)
 
         # Equation 11 in the paper
         # Use our model (noise predictor) to predict the mean
-        x0_pred, spec = self(x, waveform, t_tensor)
+        x0_pred, spec = self.denoise(x, waveform, t_tensor)
 
-        if t_index == 0:
-            sigma = 0
-            model_mean = x0_pred / self.sqrt_alphas_cumprod[t_index]
-        else:
-            sigma = 0
-            model_mean = (self.sqrt_alphas_cumprod[t_index-1]) * x0_pred + (
-                torch.sqrt(1 - self.sqrt_alphas_cumprod[t_index-1]**2 - sigma**2) * (
-                    x-self.sqrt_alphas_cumprod[t_index] * x0_pred)/self.sqrt_one_minus_alphas_cumprod[t_index]) + (
-                sigma * torch.randn_like(x))
+        # sigma = 0, the update is linear in x0_pred and x_t with coefficients
+        # precomputed for the step from t_index to self.prev_t[t_index]
+        model_mean = _x0_step_fused(
+            x, x0_pred, self.ddim_coef_x0[t_index], self.ddim_coef_xt[t_index])
 
         return model_mean, spec
 
     def ddim(self, x, waveform, t_index):
-        # boardcasting t_index into a tensor
-        t_tensor = torch.tensor(t_index).repeat(x.shape[0]).to(x.device)
+        t_tensor = self.t_tensor(x, t_index)
 
         # Equation 11 in the paper
         # Use our model (noise predictor) to predict the mean
-        epsilon, spec = self(x, waveform, t_tensor)
+        epsilon, spec = self.denoise(x, waveform, t_tensor)
 
-        if t_index == 0:
-            model_mean = (
-                x - self.sqrt_one_minus_alphas_cumprod[t_index] * epsilon) / self.sqrt_alphas_cumprod[t_index]
-        else:
-            model_mean = (self.sqrt_alphas_cumprod[t_index-1]) * (
-                (x - self.sqrt_one_minus_alphas_cumprod[t_index] * epsilon) / self.sqrt_alphas_cumprod[t_index]) + (
-                self.sqrt_one_minus_alphas_cumprod[t_index-1] * epsilon)
+        # x0 and the step to self.prev_t[t_index] folded into two coefficients,
+        # which also covers t_index == 0
+        model_mean = _x0_step_fused(
+            x, epsilon, self.ddim_eps_coef_eps[t_index], self.ddim_eps_coef_xt[t_index])
 
         return model_mean, spec
 
     def ddim2ddpm(self, x, waveform, t_index):
-        # boardcasting t_index into a tensor
-        t_tensor = torch.tensor(t_index).repeat(x.shape[0]).to(x.device)
+        t_tensor = self.t_tensor(x, t_index)
 
         # Equation 11 in the paper
         # Use our model (noise predictor) to predict the mean
-        epsilon, spec = self(x, waveform, t_tensor)
+        epsilon, spec = self.denoise(x, waveform, t_tensor)
 
+        # x0 and the noisy step to t-1 folded into precomputed coefficients,
+        # no noise is added on the last step
         if t_index == 0:
-            model_mean = (
-                x - self.sqrt_one_minus_alphas_cumprod[t_index] * epsilon) / self.sqrt_alphas_cumprod[t_index]
+            model_mean = _x0_step_fused(
+                x, epsilon, self.ddim2ddpm_coef_eps[t_index], self.ddim2ddpm_coef_xt[t_index])
         else:
-            sigma = (self.sqrt_one_minus_alphas_cumprod[t_index-1]/self.sqrt_one_minus_alphas_cumprod[t_index]) * (
-                torch.sqrt(1-self.alphas[t_index]))
-            model_mean = (self.sqrt_alphas_cumprod[t_index-1]) * (
-                (x - self.sqrt_one_minus_alphas_cumprod[t_index] * epsilon) / self.sqrt_alphas_cumprod[t_index]) + (
-                torch.sqrt(1 - self.sqrt_alphas_cumprod[t_index-1]**2 - sigma**2) * epsilon) + sigma * torch.randn_like(x)
+            model_mean = _x0_noisy_step_fused(x, epsilon, self.noise_like(x),
+                                              self.ddim2ddpm_coef_eps[t_index],
+                                              self.ddim2ddpm_coef_xt[t_index],
+                                              self.ddpm_x0_sigma[t_index])
 
         return model_mean, spec
 
@@ -1016,127 +1269,111 @@ class SpecRollDiffusion(pl.LightningModule):
 #             # Algorithm 2 line 4:
 #             return (model_mean + torch.sqrt(posterior_variance_t) * noise), spec
 
+    def cfg_denoise(self, x, waveform, t_tensor, sampling=True, **kwargs):
+        # conditional and unconditional predictions in a single (2B, ...) forward,
+        # the second half of the batch gets a zeroed waveform and, if sampling,
+        # is masked as unconditional
+        b = x.shape[0]
+        uncond_mask = torch.arange(2*b, device=x.device) >= b if sampling else False
+        x0_pred, spec = self.denoise(torch.cat([x, x]),
+                                     torch.cat([waveform, torch.zeros_like(waveform)]),
+                                     torch.cat([t_tensor, t_tensor]),
+                                     sampling=uncond_mask, **kwargs)
+        x0_pred_c, x0_pred_0 = x0_pred.chunk(2)
+        return x0_pred_c, x0_pred_0, spec[:b]
+
     def cfdg_ddpm_x0(self, x, waveform, t_index):
         # x is x_t, when t=T it is pure Gaussian
 
-        # boardcasting t_index into a tensor
-        t_tensor = torch.tensor(t_index).repeat(x.shape[0]).to(x.device)
+        # w = 0 reduces the guidance to the conditional prediction alone,
+        # the unconditional forward is skipped
+        if self.hparams.sampling.w == 0:
+            return self.ddpm_x0(x, waveform, t_index)
+
+        t_tensor = self.t_tensor(x, t_index)
 
         # Equation 11 in the paper
         # Use our model (noise predictor) to predict the mean
-        x0_pred_c, spec = self(x, waveform, t_tensor)
-        # if sampling = True, the input condition will be overwritten
-        x0_pred_0, _ = self(x, torch.zeros_like(
-            waveform), t_tensor, sampling=True)
+        x0_pred_c, x0_pred_0, spec = self.cfg_denoise(x, waveform, t_tensor)
         x0_pred = (1+self.hparams.sampling.w)*x0_pred_c - \
             self.hparams.sampling.w*x0_pred_0
 #         x0_pred = x0_pred_c
         # x0_pred = x0_pred_0
 
-        if t_index == 0:
-            sigma = (1/self.sqrt_one_minus_alphas_cumprod[t_index]) * (
-                torch.sqrt(1-self.alphas[t_index]))
-            model_mean = x0_pred / self.sqrt_alphas_cumprod[t_index]
-        else:
-            sigma = (self.sqrt_one_minus_alphas_cumprod[t_index-1]/self.sqrt_one_minus_alphas_cumprod[t_index]) * (
-                torch.sqrt(1-self.alphas[t_index]))
-            model_mean = (self.sqrt_alphas_cumprod[t_index-1]) * x0_pred + (
-                torch.sqrt(1 - self.sqrt_alphas_cumprod[t_index-1]**2 - sigma**2) * (
-                    x-self.sqrt_alphas_cumprod[t_index] * x0_pred)/self.sqrt_one_minus_alphas_cumprod[t_index]) + (
-                sigma * torch.randn_like(x))
+        model_mean = self.x0_posterior(x, x0_pred, t_index)
 
         return model_mean, spec
 
     def generation_ddpm_x0(self, x, waveform, t_index):
         # x is x_t, when t=T it is pure Gaussian
 
-        # boardcasting t_index into a tensor
-        t_tensor = torch.tensor(t_index).repeat(x.shape[0]).to(x.device)
+        t_tensor = self.t_tensor(x, t_index)
 
         # Equation 11 in the paper
         # Use our model (noise predictor) to predict the mean
         # if sampling = True, the input condition will be overwritten
-        x0_pred_0, _ = self(x, torch.zeros_like(
+        x0_pred_0, _ = self.denoise(x, torch.zeros_like(
             waveform), t_tensor, sampling=True)
         x0_pred = x0_pred_0
 
 #         x0_pred = x0_pred_c
         # x0_pred = x0_pred_0
 
-        if t_index == 0:
-            sigma = (1/self.sqrt_one_minus_alphas_cumprod[t_index]) * (
-                torch.sqrt(1-self.alphas[t_index]))
-            model_mean = x0_pred / self.sqrt_alphas_cumprod[t_index]
-        else:
-            sigma = (self.sqrt_one_minus_alphas_cumprod[t_index-1]/self.sqrt_one_minus_alphas_cumprod[t_index]) * (
-                torch.sqrt(1-self.alphas[t_index]))
-            model_mean = (self.sqrt_alphas_cumprod[t_index-1]) * x0_pred + (
-                torch.sqrt(1 - self.sqrt_alphas_cumprod[t_index-1]**2 - sigma**2) * (
-                    x-self.sqrt_alphas_cumprod[t_index] * x0_pred)/self.sqrt_one_minus_alphas_cumprod[t_index]) + (
-                sigma * torch.randn_like(x))
+        model_mean = self.x0_posterior(x, x0_pred, t_index)
 
         return model_mean, _
 
     def inpainting_ddpm_x0(self, x, waveform, t_index):
         # x is x_t, when t=T it is pure Gaussian
 
-        # boardcasting t_index into a tensor
-        t_tensor = torch.tensor(t_index).repeat(x.shape[0]).to(x.device)
+        t_tensor = self.t_tensor(x, t_index)
 
         # Equation 11 in the paper
         # Use our model (noise predictor) to predict the mean
-        x0_pred_c, spec = self(
-            x, waveform, t_tensor, inpainting_t=self.hparams.inpainting_t, inpainting_f=self.hparams.inpainting_f)
-        # if sampling = True, the input condition will be overwritten
-        x0_pred_0, _ = self(x, torch.zeros_like(
-            waveform), t_tensor, sampling=True)
-        x0_pred = (1+self.hparams.sampling.w)*x0_pred_c - \
-            self.hparams.sampling.w*x0_pred_0
+        # the unconditional half is overwritten entirely, so inpainting only
+        # affects the conditional prediction
+        inpainting = dict(inpainting_t=self.hparams.inpainting_t,
+                          inpainting_f=self.hparams.inpainting_f)
+        if self.hparams.sampling.w == 0:
+            # no guidance, only the conditional prediction is needed
+            x0_pred, spec = self.denoise(x, waveform, t_tensor, **inpainting)
+        else:
+            x0_pred_c, x0_pred_0, spec = self.cfg_denoise(
+                x, waveform, t_tensor, **inpainting)
+            x0_pred = (1+self.hparams.sampling.w)*x0_pred_c - \
+                self.hparams.sampling.w*x0_pred_0
 #         x0_pred = x0_pred_c
         # x0_pred = x0_pred_0
 
-        if t_index == 0:
-            sigma = (1/self.sqrt_one_minus_alphas_cumprod[t_index]) * (
-                torch.sqrt(1-self.alphas[t_index]))
-            model_mean = x0_pred / self.sqrt_alphas_cumprod[t_index]
-        else:
-            sigma = (self.sqrt_one_minus_alphas_cumprod[t_index-1]/self.sqrt_one_minus_alphas_cumprod[t_index]) * (
-                torch.sqrt(1-self.alphas[t_index]))
-            model_mean = (self.sqrt_alphas_cumprod[t_index-1]) * x0_pred + (
-                torch.sqrt(1 - self.sqrt_alphas_cumprod[t_index-1]**2 - sigma**2) * (
-                    x-self.sqrt_alphas_cumprod[t_index] * x0_pred)/self.sqrt_one_minus_alphas_cumprod[t_index]) + (
-                sigma * torch.randn_like(x))
+        model_mean = self.x0_posterior(x, x0_pred, t_index)
 
         return model_mean, spec
 
     def cfdg_ddim_x0(self, x, waveform, t_index):
         # x is x_t, when t=T it is pure Gaussian
 
-        # boardcasting t_index into a tensor
-        t_tensor = torch.tensor(t_index).repeat(x.shape[0]).to(x.device)
+        # w = 0 reduces the guidance to the conditional prediction alone,
+        # the unconditional forward is skipped
+        if self.hparams.sampling.w == 0:
+            return self.ddim_x0(x, waveform, t_index)
 
-        # Equation 11 in the paper
-        # Use our model (noise predictor) to predict the mean
-        x0_pred, spec = self(x, waveform, t_tensor)
+        t_tensor = self.t_tensor(x, t_index)
 
         # Equation 11 in the paper
         # Use our model (noise predictor) to predict the mean
-        x0_pred_c, spec = self(x, waveform, t_tensor)
-        x0_pred_0, _ = self(x, torch.zeros_like(waveform), t_tensor)
+        # the unconditional half only sees a zeroed waveform, the model does not
+        # overwrite it
+        x0_pred_c, x0_pred_0, spec = self.cfg_denoise(
+            x, waveform, t_tensor, sampling=False)
         x0_pred = (1+self.hparams.sampling.w)*x0_pred_c - \
             self.hparams.sampling.w*x0_pred_0
 #         x0_pred = x0_pred_c
         # x0_pred = x0_pred_0
 
-        if t_index == 0:
-            sigma = 0
-            model_mean = x0_pred / self.sqrt_alphas_cumprod[t_index]
-        else:
-            sigma = 0
-            model_mean = (self.sqrt_alphas_cumprod[t_index-1]) * x0_pred + (
-                torch.sqrt(1 - self.sqrt_alphas_cumprod[t_index-1]**2 - sigma**2) * (
-                    x-self.sqrt_alphas_cumprod[t_index] * x0_pred)/self.sqrt_one_minus_alphas_cumprod[t_index]) + (
-                sigma * torch.randn_like(x))
+        # sigma = 0, the update is linear in x0_pred and x_t with coefficients
+        # precomputed for the step from t_index to self.prev_t[t_index]
+        model_mean = _x0_step_fused(
+            x, x0_pred, self.ddim_coef_x0[t_index], self.ddim_coef_xt[t_index])
 
         return model_mean, spec
 
@@ -1152,29 +1389,33 @@ class SpecRollDiffusion(pl.LightningModule):
 #         return [optimizer], [{"scheduler":scheduler, "interval": "step"}]
         return [optimizer]
 
-    def animate_sampling(self, t_idx, fig, ax_flat, caxs, noise_list):
-        # Tuple of (x_t, t), (x_t-1, t-1), ... (x_0, 0)
+    def animate_sampling(self, t_idx, fig, ax_flat, caxs, x_by_t):
+        # x_by_t maps t to the roll stored at that step, x_T under t=timesteps
         # x_t (B, 1, T, F)
-        # clearing figures to prevent slow down in each iteration.d
-        fig.canvas.draw()
-        # visualize only 4 piano rolls
-        for idx in range(len(noise_list[0][0])):
-            ax_flat[idx].cla()
-            ax_flat[4+idx].cla()
-            caxs[idx].cla()
-            caxs[4+idx].cla()
-
-            # roll_pred (1, T, F)
-            im1 = ax_flat[idx].imshow(
-                noise_list[0][0][idx][0].detach().T.cpu(), aspect='auto', origin='lower')
-            im2 = ax_flat[4+idx].imshow(noise_list[1+self.hparams.timesteps-t_idx]
-                                        [0][idx][0].T, aspect='auto', origin='lower')
-            fig.colorbar(im1, cax=caxs[idx])
-            fig.colorbar(im2, cax=caxs[4+idx])
+        x_prev = x_by_t[t_idx]
+        # images, colorbars and labels are built on the first frame only,
+        # later frames just swap the data of the x_{t-1} row
+        if not ax_flat[4].images:
+            # visualize only 4 piano rolls, x_T copied to host in a single transfer
+            x_T = x_by_t[self.hparams.timesteps][:4, 0].detach().transpose(-1, -2).cpu()
+            for idx in range(len(x_prev)):
+                # roll_pred (1, T, F)
+                im1 = ax_flat[idx].imshow(
+                    x_T[idx], aspect='auto', origin='lower')
+                im2 = ax_flat[4+idx].imshow(
+                    x_prev[idx][0].T, aspect='auto', origin='lower')
+                fig.colorbar(im1, cax=caxs[idx])
+                fig.colorbar(im2, cax=caxs[4+idx])
+            row1_txt = ax_flat[0].text(-400, 45, f'Gaussian N(0,1)')
+            row2_txt = ax_flat[4].text(-300, 45, 'x_{t-1}')
+        else:
+            for idx in range(len(x_prev)):
+                im2 = ax_flat[4+idx].images[0]
+                im2.set_data(x_prev[idx][0].T)
+                # rescale like a fresh imshow, the colorbar follows the image
+                im2.autoscale()
 
         fig.suptitle(f't={t_idx}')
-        row1_txt = ax_flat[0].text(-400, 45, f'Gaussian N(0,1)')
-        row2_txt = ax_flat[4].text(-300, 45, 'x_{t-1}')
 
 
 class LatentRollDiffusion(pl.LightningModule):
@@ -1193,7 +1434,11 @@ class LatentRollDiffusion(pl.LightningModule):
                  curriculum_learning=False,
                  curriculum_alpha=1.5,
                  curriculum_min_t_ratio=0.1,
-                 curriculum_full_t_ratio=0.5
+                 curriculum_full_t_ratio=0.5,
+                 compile_model=False,
+                 compile_mode="reduce-overhead",
+                 bf16_sampling=False,
+                 save_intermediates=False,
                  ):
         super().__init__()
 
@@ -1208,28 +1453,50 @@ class LatentRollDiffusion(pl.LightningModule):
         # define beta schedule
         # self.betas = linear_beta_schedule(
         #     beta_start, beta_end, timesteps=timesteps)
-        self.betas = cosine_beta_schedule(timesteps)
-
-        # define alphas
-        alphas = 1. - self.betas
-        alphas_cumprod = torch.cumprod(alphas, axis=0)
-        print('first timestep alpha', alphas_cumprod[0])
-        print('last timestep alpha', alphas_cumprod[-1])
-        alphas_cumprod_prev = F.pad(alphas_cumprod[:-1], (1, 0), value=1.0)
-        self.sqrt_recip_alphas = torch.sqrt(1.0 / alphas)
-
-        # calculations for diffusion q(x_t | x_{t-1}) and others
-        self.sqrt_alphas_cumprod = torch.sqrt(alphas_cumprod)
-        self.sqrt_one_minus_alphas_cumprod = torch.sqrt(1. - alphas_cumprod)
-
-        # calculations for posterior q(x_{t-1} | x_t, x_0)
-        self.posterior_variance = self.betas * \
-            (1. - alphas_cumprod_prev) / (1 - alphas_cumprod)
+        # the schedule is registered as non-persistent buffers so that it follows
+        # the module to its device without being stored in the checkpoints
+        for name, tensor in make_schedule(cosine_beta_schedule(timesteps)).items():
+            self.register_buffer(name, tensor, persistent=False)
+        print('first timestep alpha', self.sqrt_alphas_cumprod[0]**2)
+        print('last timestep alpha', self.sqrt_alphas_cumprod[-1]**2)
         self.inner_loop = tqdm(range(self.hparams.timesteps),
                                desc='sampling loop time step')
 
         self.reverse_diffusion = getattr(self, sampling.type)
-        self.alphas = alphas
+        # training objective resolved once instead of branching on every batch
+        if training.mode not in ['epsilon', 'x_0']:
+            raise ValueError(
+                f"training mode {training.mode} is not supported. Please either use 'x_0' or 'epsilon'.")
+        self.objective_step = getattr(self, f"{training.mode}_step")
+        self._t_table = None
+        self._noise_buf = None
+        self._io_pool = None
+        self._io_futures = []
+        self._compiled_denoiser = None
+        if compile_model:
+            # compiled lazily on the first call, after the subclass has built its layers,
+            # "reduce-overhead" replays each sampling step as a CUDA graph
+            self._compiled_denoiser = torch.compile(
+                self.forward, mode=compile_mode, dynamic=False, fullgraph=True)
+
+    def on_predict_end(self):
+        self.wait_io()
+
+    def submit_io(self, fn, *args, **kwargs):
+        # midi files are written on a small thread pool so that the writes
+        # overlap with the sampling of the next batch
+        if self._io_pool is None:
+            self._io_pool = ThreadPoolExecutor(max_workers=4)
+        self._io_futures.append(self._io_pool.submit(fn, *args, **kwargs))
+
+    def wait_io(self):
+        # result() re-raises any exception from the writes
+        for future in self._io_futures:
+            future.result()
+        self._io_futures = []
+        if self._io_pool is not None:
+            self._io_pool.shutdown()
+            self._io_pool = None
 
     def training_step(self, batch, batch_idx):
         losses, _ = self.step(batch, batch_idx)
@@ -1247,9 +1514,10 @@ class LatentRollDiffusion(pl.LightningModule):
         total_loss = 0
         for k in self.hparams.loss_keys:
             total_loss += losses[k]
-            self.log(f"Val/{k}", losses[k])
+            # averaged over ranks, Val/diffusion_loss is monitored for checkpointing
+            self.log(f"Val/{k}", losses[k], sync_dist=True)
 
-        if batch_idx == 0:
+        if batch_idx == 0 and self.trainer.is_global_zero:
             self.visualize_figure(
                 tensors['pred_roll'], 'Val/pred_roll', batch_idx)
 
@@ -1270,6 +1538,7 @@ class LatentRollDiffusion(pl.LightningModule):
                 #     self.visualize_latents(
                 #         tensors['latents'], 'Val/latents', batch_idx)
 
+    @torch.inference_mode()
     def test_step(self, batch, batch_idx):
         noise_list, latents = self.sampling(batch, batch_idx)
 
@@ -1277,45 +1546,22 @@ class LatentRollDiffusion(pl.LightningModule):
         roll_pred = noise_list[-1][0]  # (B, 1, T, F)
         roll_label = batch["frame"].unsqueeze(1).cpu()
 
-        if batch_idx == 0:
+        # only rank 0 writes the debug files and figures
+        if batch_idx == 0 and self.trainer.is_global_zero:
             torch.save(latents, 'latents.pt')
             # self.visualize_latents(latents, 'Test/latents', batch_idx)
             for noise_npy, t_index in noise_list:
                 if (t_index+1) % 10 == 0:
-                    fig, ax = plt.subplots(2, 2)
-                    for idx, j in enumerate(noise_npy):
-                        # j (1, T, F)
-                        if idx >= 4:
-                            break
-                        ax.flatten()[idx].imshow(
-                            j[0].T, aspect='auto', origin='lower')
-                        self.logger.experiment.add_figure(
-                            f"Test/pred",
-                            fig,
-                            global_step=self.hparams.timesteps-t_index)
-                        plt.close()
+                    self.visualize_grid(noise_npy, 'Test/pred',
+                                        self.hparams.timesteps-t_index)
                     # self.visualize_latents(torch.from_numpy(
                     #     noise_npy), 'Test/pred', batch_idx, t_index)
 
-            fig1, ax1 = plt.subplots(2, 2)
-            fig2, ax2 = plt.subplots(2, 2)
-            for idx in range(4):
-
-                ax1.flatten()[idx].imshow(roll_label[idx][0].T,
-                                          aspect='auto', origin='lower')
-                self.logger.experiment.add_figure(
-                    f"Test/label",
-                    fig1,
-                    global_step=0)
-
-                ax2.flatten()[idx].imshow(
-                    (roll_pred[idx][0] > self.hparams.frame_threshold).T, aspect='auto', origin='lower')
-                self.logger.experiment.add_figure(
-                    f"Test/pred_roll",
-                    fig2,
-                    global_step=0)
-                plt.close()
-            torch.save(noise_list, 'noise_list.pt')
+            self.visualize_grid(roll_label, 'Test/label', 0)
+            self.visualize_grid(
+                roll_pred > self.hparams.frame_threshold, 'Test/pred_roll', 0)
+            if self.hparams.save_intermediates:
+                torch.save(noise_list, 'noise_list.pt')
 
             # ======== Begins animation ===========
             # t_list = torch.arange(1, self.hparams.timesteps, 5).flip(0)
@@ -1350,9 +1596,8 @@ class LatentRollDiffusion(pl.LightningModule):
         print(roll_pred.max())
 
         # ======== Animation saved ===========
-        frame_p, frame_r, frame_f1, _ = precision_recall_fscore_support(roll_label.flatten(),
-                                                                        roll_pred.flatten() > self.hparams.frame_threshold,
-                                                                        average='binary')
+        frame_p, frame_r, frame_f1 = frame_precision_recall_f1(roll_label,
+                                                               roll_pred > self.hparams.frame_threshold)
         print((roll_pred.flatten() > self.hparams.frame_threshold).sum())
         print(roll_label.flatten().sum())
         print(frame_f1)
@@ -1378,13 +1623,12 @@ class LatentRollDiffusion(pl.LightningModule):
             # scaling = 512 / 16000
             # scaling = 2048/48000
             # scaling = HOP_LENGTH / SAMPLE_RATE
-            scaling = 128 / 16000
 
             # Converting time steps to seconds and midi number to frequency
-            i_ref = (i_ref * scaling).reshape(-1, 2)
-            p_ref = np.array([midi_to_hz(MIN_MIDI + midi) for midi in p_ref])
-            i_est = (i_est * scaling).reshape(-1, 2)
-            p_est = np.array([midi_to_hz(MIN_MIDI + midi) for midi in p_est])
+            i_ref = (i_ref * LATENT_SCALING).reshape(-1, 2)
+            p_ref = PITCH_HZ[p_ref]
+            i_est = (i_est * LATENT_SCALING).reshape(-1, 2)
+            p_est = PITCH_HZ[p_est]
 
             p, r, f, o = evaluate_notes(
                 i_ref, p_ref, i_est, p_est, offset_ratio=None)
@@ -1411,24 +1655,31 @@ class LatentRollDiffusion(pl.LightningModule):
             print(f"-------Note F1: {f}--------")
         self.log("Test/Frame_F1", frame_f1)
 
+    @torch.inference_mode()
     def predict_step(self, batch, batch_idx):
         print("-----PREDICT STEP------")
         # TODO: check if this is correct, should we index by string and not number?
         noise = batch[0]
         latents = batch[1]
-        self.inner_loop.refresh()
+        # reset() also redraws the bar
         self.inner_loop.reset()
 
         noise_list = []
         noise_list.append((noise, self.hparams.timesteps))
 
-        for t_index in reversed(range(0, self.hparams.timesteps)):
+        for i, t_index in enumerate(reversed(range(0, self.hparams.timesteps))):
             noise, _ = self.reverse_diffusion(noise, latents, t_index)
-            noise_npy = noise.detach().cpu().numpy()
             # self.hparams.timesteps-i is used because slide bar won't show
             # if global step starts from self.hparams.timesteps
-            noise_list.append((noise_npy, t_index))
-            self.inner_loop.update()
+            # steps stay on device, so only the frames that are used are kept: the final
+            # roll, and for the first batch the Test/pred figures and the animation frames
+            if t_index == 0 or (batch_idx == 0 and (self.keep_step(t_index) or t_index % 5 == 0)):
+                noise_list.append((noise.detach(), t_index))
+            # the progress bar is only advanced every 10 steps
+            if (i+1) % 10 == 0:
+                self.inner_loop.update(10)
+        self.inner_loop.update(self.hparams.timesteps % 10)
+        noise_list = trajectory_to_numpy(noise_list)
             # ======== Animation saved ===========
 
         # noise_list is a list of tuple (pred_t, t), ..., (pred_0, 0)
@@ -1440,41 +1691,21 @@ class LatentRollDiffusion(pl.LightningModule):
                                   batch_idx)
             for noise_npy, t_index in noise_list:
                 if (t_index+1) % 10 == 0:
-                    fig, ax = plt.subplots(2, 2)
-                    for idx, j in enumerate(noise_npy):
-                        if idx < 4:
-                            # j (1, T, F)
-                            ax.flatten()[idx].imshow(
-                                j[0].T, aspect='auto', origin='lower')
-                            self.logger.experiment.add_figure(
-                                f"Test/pred",
-                                fig,
-                                global_step=self.hparams.timesteps-t_index)
-                            plt.close()
-                        else:
-                            break
-
-            fig1, ax1 = plt.subplots(2, 2)
-            fig2, ax2 = plt.subplots(2, 2)
-            for idx, roll_pred_i in enumerate(roll_pred):
-
-                ax2.flatten()[idx].imshow(
-                    (roll_pred_i[0] > self.hparams.frame_threshold).T, aspect='auto', origin='lower')
-                self.logger.experiment.add_figure(
-                    f"Test/pred_roll",
-                    fig2,
-                    global_step=0)
-                plt.close()
-
-            torch.save(noise_list, 'noise_list.pt')
+                    self.visualize_grid(noise_npy, 'Test/pred',
+                                        self.hparams.timesteps-t_index)
+
+            self.visualize_grid(
+                roll_pred > self.hparams.frame_threshold, 'Test/pred_roll', 0)
+
+            if self.hparams.save_intermediates:
+                torch.save(noise_list, 'noise_list.pt')
             # torch.save(spec, 'spec.pt')
             # torch.save(roll_label, 'roll_label.pt')
 
             # ======== Begins animation ===========
-            t_list = torch.arange(1, self.hparams.timesteps, 5).flip(0)
-            if t_list[-1] != self.hparams.timesteps:
-                t_list = torch.cat(
-                    (t_list, torch.tensor([self.hparams.timesteps])), 0)
+            # every 5th step, looked up by t since only the used frames are kept
+            x_by_t = {t_index: noise_npy for noise_npy, t_index in noise_list}
+            t_list = [t_index for _, t_index in noise_list[1:] if t_index % 5 == 0]
             ims = []
             fig, axes = plt.subplots(2, 4, figsize=(16, 5))
 
@@ -1490,7 +1721,7 @@ class LatentRollDiffusion(pl.LightningModule):
                                           frames=tqdm(
                                               t_list, desc='Animating'),
                                           fargs=(fig, ax_flat, caxs,
-                                                 noise_list, ),
+                                                 x_by_t, ),
                                           interval=500,
                                           blit=False,
                                           repeat_delay=1000)
@@ -1498,33 +1729,13 @@ class LatentRollDiffusion(pl.LightningModule):
             # ======== Animation saved ===========
 
         # export as midi
+        # note extraction and the writes of every roll run on the I/O pool
         for roll_idx, np_frame in enumerate(noise_list[-1][0]):
             # np_frame = (1, T, 88)
-            np_frame = np_frame[0]
-            p_est, i_est = extract_notes_wo_velocity(np_frame, np_frame)
-
-            # scaling = HOP_LENGTH / SAMPLE_RATE
-            scaling = 128 / 16000
-            # Converting time steps to seconds and midi number to frequency
-            i_est = (i_est * scaling).reshape(-1, 2)
-            p_est = np.array([midi_to_hz(MIN_MIDI + midi) for midi in p_est])
-
-            clean_notes = (i_est[:, 1]-i_est[:, 0]
-                           ) > self.hparams.generation_filter
-
-            save_midi(os.path.join('./', f'clean_midi_e{batch_idx}_{roll_idx}.mid'),
-                      p_est[clean_notes],
-                      i_est[clean_notes],
-                      [127]*len(p_est))
-            save_midi(os.path.join('./', f'raw_midi_{batch_idx}_{roll_idx}.mid'),
-                      p_est,
-                      i_est,
-                      [127]*len(p_est))
-
-            save_midi(os.path.join('./', f'raw_midi_{batch_idx}_{roll_idx}.mid'),
-                      p_est,
-                      i_est,
-                      [127]*len(p_est))
+            self.submit_io(export_midi, np_frame[0], LATENT_SCALING,
+                           self.hparams.generation_filter,
+                           os.path.join('./', f'clean_midi_e{batch_idx}_{roll_idx}.mid'),
+                           os.path.join('./', f'raw_midi_{batch_idx}_{roll_idx}.mid'))
 
     # def visualize_latents(self, latents, tag, batch_idx):
     #     """New method to visualize DAC latents"""
@@ -1535,17 +1746,29 @@ class LatentRollDiffusion(pl.LightningModule):
     #         im = ax.flatten()[idx].imshow(
 
     def visualize_figure(self, tensors, tag, batch_idx):
+        # only rank 0 logs, the other ranks skip the device->host copy
+        if not self.trainer.is_global_zero:
+            return
         fig, ax = plt.subplots(2, 2)
-        for idx, tensor in enumerate(tensors):  # visualize only 4 piano rolls
-            # roll_pred (1, T, F)
-            if (idx >= ax.flatten().size):
-                break
-            ax.flatten()[idx].imshow(tensor[0].T.cpu(),
-                                     aspect='auto', origin='lower')
+        flat_ax = ax.flatten()
+        # visualize only 4 piano rolls, copied to host in a single transfer
+        rolls = tensors[:flat_ax.size, 0].detach().transpose(-1, -2).cpu()
+        for axis, roll in zip(flat_ax, rolls):
+            # roll (F, T)
+            axis.imshow(roll, aspect='auto', origin='lower')
         self.logger.experiment.add_figure(
             f"{tag}", fig, global_step=self.current_epoch)
         plt.close()
 
+    def visualize_grid(self, tensors, tag, global_step):
+        # tiling the first 4 piano rolls (B, 1, T, F) into one image,
+        # a single add_image instead of a matplotlib figure per roll
+        rolls = torch.as_tensor(tensors[:4]).float()
+        # (b, 1, F, T) with the lowest pitch at the bottom, like origin='lower'
+        rolls = rolls.transpose(-1, -2).flip(-2)
+        grid = make_grid(rolls, nrow=2, normalize=True, pad_value=1)
+        self.logger.experiment.add_image(tag, grid, global_step=global_step)
+
     def step(self, batch, batch_idx):
         # batch["frame"] (B, T, 88)
         # batch["audio"] (B, L)
@@ -1570,9 +1793,10 @@ class LatentRollDiffusion(pl.LightningModule):
         #         self.trainer.max_epochs,
         #         self.curriculum_alpha,
         #         self.curriculum_min_t_ratio,
-        #         self.curriculum_full_t_ratio).to(device)
+        #         self.curriculum_full_t_ratio,
+        #         device=device)
         # else:
-        #     t = sample_timesteps(batch_size, self.hparams.timesteps, alpha=0.0)
+        #     t = sample_timesteps(batch_size, self.hparams.timesteps, alpha=0.0, device=device)
 
         # EXPERIMENTAL: try weighted sampling
         # if random.random() < 0.5:
@@ -1584,32 +1808,13 @@ class LatentRollDiffusion(pl.LightningModule):
 
         noise = torch.randn_like(roll)
 
-        x_t = q_sample(
-            x_start=roll,
-            t=t,
-            sqrt_alphas_cumprod=self.sqrt_alphas_cumprod,
-            sqrt_one_minus_alphas_cumprod=self.sqrt_one_minus_alphas_cumprod,
-            noise=noise)
-
-        if self.hparams.training.mode == 'epsilon':
-            if self.hparams.debug:
-                epsilon_pred, latent_features = self(x_t, roll, t)
-            else:
-                epsilon_pred, latent_features = self(x_t, latents, t)
-            diffusion_loss = self.p_losses(
-                noise, epsilon_pred, loss_type=self.hparams.loss_type)
-
-            pred_roll = extract_x0(
-                x_t,
-                epsilon_pred,
-                t,
-                sqrt_alphas_cumprod=self.sqrt_alphas_cumprod,
-                sqrt_one_minus_alphas_cumprod=self.sqrt_one_minus_alphas_cumprod)
+        # coefficients at t gathered once and shared by q_sample and extract_x0
+        schedule_t = gather_schedule(
+            t, self.sqrt_alphas_cumprod, self.sqrt_one_minus_alphas_cumprod)
+        x_t = _q_sample_fused(roll, noise, *schedule_t)
 
-        elif self.hparams.training.mode == 'x_0':
-            pred_roll, latent_features = self(x_t, latents, t)
-            diffusion_loss = self.p_losses(
-                roll, pred_roll, loss_type=self.hparams.loss_type)
+        diffusion_loss, pred_roll, latent_features = self.objective_step(
+            roll, latents, x_t, t, noise, schedule_t)
 
         return {
             'diffusion_loss': diffusion_loss,
@@ -1619,6 +1824,7 @@ class LatentRollDiffusion(pl.LightningModule):
             'latents': latent_features.detach() if latent_features is not None else None
         }
 
+    @torch.inference_mode()
     def sampling(self, batch, batch_idx):
         """
         Sampling process for the diffusion model
@@ -1627,7 +1833,7 @@ class LatentRollDiffusion(pl.LightningModule):
         roll = self.normalize(batch["frame"]).unsqueeze(1)
         latents = batch["dac_latents"]  # DAC latents
 
-        self.inner_loop.refresh()
+        # reset() also redraws the bar
         self.inner_loop.reset()
 
         # Start from random noise
@@ -1654,7 +1860,7 @@ class LatentRollDiffusion(pl.LightningModule):
 
         # Reverse diffusion process
         # t index goes from 199 to 0 inclusive
-        for t_index in reversed(range(0, self.hparams.timesteps)):
+        for i, t_index in enumerate(reversed(range(0, self.hparams.timesteps))):
             # for t_index in reversed(range(0, fixed_t)):
             if self.hparams.debug:
                 # For debugging, use piano roll as conditioning
@@ -1665,17 +1871,42 @@ class LatentRollDiffusion(pl.LightningModule):
                 noise, latent_features = self.reverse_diffusion(
                     noise, latents, t_index)
 
-            # Store intermediate results
-            noise_npy = noise.detach().cpu().numpy()
-            noise_list.append((noise_npy, t_index))
+            # Store intermediate results, kept on device until the loop ends
+            if self.keep_step(t_index):
+                noise_list.append((noise.detach(), t_index))
 
-            self.inner_loop.update()
+            # the progress bar is only advanced every 10 steps
+            if (i+1) % 10 == 0:
+                self.inner_loop.update(10)
+        self.inner_loop.update(self.hparams.timesteps % 10)
 
         # Optional: save animation frames
         # if batch_idx == 0:
         #     self.save_sampling_animation(noise_list)
 
-        return noise_list, latents
+        return trajectory_to_numpy(noise_list), latents
+
+    def keep_step(self, t_index):
+        # the whole trajectory is only kept when it is saved to disk,
+        # otherwise only the steps plotted by test_step, and the final x_0, are kept
+        return self.hparams.save_intermediates or (t_index+1) % 10 == 0 or t_index == 0
+
+    def epsilon_step(self, roll, latents, x_t, t, noise, schedule_t):
+        # For debugging, use piano roll as conditioning
+        condition = roll if self.hparams.debug else latents
+        epsilon_pred, latent_features = self(x_t, condition, t)
+        diffusion_loss = self.p_losses(
+            noise, epsilon_pred, loss_type=self.hparams.loss_type)
+
+        # the implied x_0 is only logged, so it is kept out of the autograd graph
+        pred_roll = _extract_x0_fused(x_t, epsilon_pred.detach(), *schedule_t)
+        return diffusion_loss, pred_roll, latent_features
+
+    def x_0_step(self, roll, latents, x_t, t, noise, schedule_t):
+        pred_roll, latent_features = self(x_t, latents, t)
+        diffusion_loss = self.p_losses(
+            roll, pred_roll, loss_type=self.hparams.loss_type)
+        return diffusion_loss, pred_roll, latent_features
 
     def p_losses(self, label, prediction, loss_type="l1"):
         if loss_type == 'l1':
@@ -1689,32 +1920,61 @@ class LatentRollDiffusion(pl.LightningModule):
 
         return loss
 
+    def denoise(self, *args, **kwargs):
+        # forward pass used inside the sampling loop
+        denoiser = self if self._compiled_denoiser is None else self._compiled_denoiser
+        if not self.hparams.bf16_sampling:
+            return denoiser(*args, **kwargs)
+
+        with torch.autocast(device_type=self.device.type, dtype=torch.bfloat16):
+            output = denoiser(*args, **kwargs)
+        # casting the prediction back so that the schedule math stays in fp32
+        return cast_float(output)
+
+    def t_tensor(self, x, t_index):
+        # rows of a (timesteps, B) table of every t_index, built once per batch size
+        # so that each step only takes a view instead of a host->device copy
+        if self._t_table is None or self._t_table.shape[1] != x.shape[0] or self._t_table.device != x.device:
+            self._t_table = torch.arange(
+                self.hparams.timesteps, device=x.device)[:, None].repeat(1, x.shape[0])
+        return self._t_table[t_index]
+
+    def noise_like(self, x):
+        # in-place normal_() into a reused buffer instead of a fresh randn_like per step
+        if self._noise_buf is None or self._noise_buf.shape != x.shape or \
+                self._noise_buf.device != x.device or self._noise_buf.dtype != x.dtype:
+            self._noise_buf = torch.empty_like(x)
+        return self._noise_buf.normal_()
+
     def ddpm(self, x, latents, t_index):
         # x is Guassian noise
 
-        # extracting coefficients at time t
-        betas_t = self.betas[t_index]
-        sqrt_one_minus_alphas_cumprod_t = self.sqrt_one_minus_alphas_cumprod[t_index]
-        sqrt_recip_alphas_t = self.sqrt_recip_alphas[t_index]
-
-        # boardcasting t_index into a tensor
-        t_tensor = torch.tensor(t_index).repeat(x.shape[0]).to(x.device)
+        t_tensor = self.t_tensor(x, t_index)
 
         # Equation 11 in the paper
         # Use our model (noise predictor) to predict the mean
-        epsilon, latent_features = self(x, latents, t_tensor)
+        epsilon, latent_features = self.denoise(x, latents, t_tensor)
 
-        model_mean = sqrt_recip_alphas_t * (
-            x - betas_t * epsilon / sqrt_one_minus_alphas_cumprod_t
-        )
+        # coefficients precomputed in make_schedule, one fused kernel per step
         if t_index == 0:
-            return model_mean, latent_features
-        else:
-            # posterior_variance_t = extract(self.posterior_variance, t, x.shape)
-            posterior_variance_t = self.posterior_variance[t_index]
-            noise = torch.randn_like(x)
-            # Algorithm 2 line 4:
-            return (model_mean + torch.sqrt(posterior_variance_t) * noise), latent_features
+            return _x0_step_fused(x, epsilon, self.ddpm_eps_coef_eps[t_index],
+                                  self.ddpm_eps_coef_xt[t_index]), latent_features
+        # Algorithm 2 line 4:
+        return _x0_noisy_step_fused(x, epsilon, self.noise_like(x),
+                                    self.ddpm_eps_coef_eps[t_index],
+                                    self.ddpm_eps_coef_xt[t_index],
+                                    self.ddpm_x0_sigma[t_index]), latent_features
+
+    def x0_posterior(self, x, x0_pred, t_index):
+        # ddpm posterior step from an x0 prediction as one fused elementwise kernel,
+        # no noise is added on the last step
+        if t_index == 0:
+            return _x0_step_fused(x, x0_pred, self.ddpm_x0_coef_x0[t_index],
+                                  self.ddpm_x0_coef_xt[t_index])
+        return _x0_noisy_step_fused(x, x0_pred, self.noise_like(x),
+                                    self.ddpm_x0_coef_x0[t_index],
+                                    self.ddpm_x0_coef_xt[t_index],
+                                    self.ddpm_x0_sigma[t_index])
 
     def ddpm_x0(self, x, latents, t_index):
         """DDPM sampling with x0 parameterization
@@ -1723,22 +1983,12 @@ class LatentRollDiffusion(pl.LightningModule):
             latents: DAC latents for conditioning (B, 72/96, T)
             t_index: current timestep
         """
-        t_tensor = torch.tensor(t_index).repeat(x.shape[0]).to(x.device)
+        t_tensor = self.t_tensor(x, t_index)
 
         # Predict x0 using the model
-        x0_pred, latent_features = self(x, latents, t_tensor)
+        x0_pred, latent_features = self.denoise(x, latents, t_tensor)
 
-        if t_index == 0:
-            sigma = (1/self.sqrt_one_minus_alphas_cumprod[t_index]) * (
-                torch.sqrt(1-self.alphas[t_index]))
-            model_mean = x0_pred / self.sqrt_alphas_cumprod[t_index]
-        else:
-            sigma = (self.sqrt_one_minus_alphas_cumprod[t_index-1]/self.sqrt_one_minus_alphas_cumprod[t_index]) * (
-                torch.sqrt(1-self.alphas[t_index]))
-            model_mean = (self.sqrt_alphas_cumprod[t_index-1]) * x0_pred + (
-                torch.sqrt(1 - self.sqrt_alphas_cumprod[t_index-1]**2 - sigma**2) * (
-                    x-self.sqrt_alphas_cumprod[t_index] * x0_pred)/self.sqrt_one_minus_alphas_cumprod[t_index]) + (
-                sigma * torch.randn_like(x))
+        model_mean = self.x0_posterior(x, x0_pred, t_index)
 
         return model_mean, latent_features
 
@@ -1749,60 +1999,63 @@ class LatentRollDiffusion(pl.LightningModule):
             latents: DAC latents for conditioning (B, 72/96, T)
             t_index: current timestep
         """
-        t_tensor = torch.tensor(t_index).repeat(x.shape[0]).to(x.device)
+        t_tensor = self.t_tensor(x, t_index)
 
-        x0_pred, latent_features = self(x, latents, t_tensor)
+        x0_pred, latent_features = self.denoise(x, latents, t_tensor)
 
-        if t_index == 0:
-            sigma = 0
-            model_mean = x0_pred / self.sqrt_alphas_cumprod[t_index]
-        else:
-            sigma = 0
-            model_mean = (self.sqrt_alphas_cumprod[t_index-1]) * x0_pred + (
-                torch.sqrt(1 - self.sqrt_alphas_cumprod[t_index-1]**2 - sigma**2) * (
-                    x-self.sqrt_alphas_cumprod[t_index] * x0_pred)/self.sqrt_one_minus_alphas_cumprod[t_index]) + (
-                sigma * torch.randn_like(x))
+        # sigma = 0, the update is linear in x0_pred and x_t with precomputed coefficients
+        model_mean = _x0_step_fused(
+            x, x0_pred, self.ddim_coef_x0[t_index], self.ddim_coef_xt[t_index])
 
         return model_mean, latent_features
 
     def ddim(self, x, latents, t_index):
-        # boardcasting t_index into a tensor
-        t_tensor = torch.tensor(t_index).repeat(x.shape[0]).to(x.device)
+        t_tensor = self.t_tensor(x, t_index)
 
         # Equation 11 in the paper
         # Use our model (noise predictor) to predict the mean
-        epsilon, latent_features = self(x, latents, t_tensor)
+        epsilon, latent_features = self.denoise(x, latents, t_tensor)
 
-        if t_index == 0:
-            model_mean = (
-                x - self.sqrt_one_minus_alphas_cumprod[t_index] * epsilon) / self.sqrt_alphas_cumprod[t_index]
-        else:
-            model_mean = (self.sqrt_alphas_cumprod[t_index-1]) * (
-                (x - self.sqrt_one_minus_alphas_cumprod[t_index] * epsilon) / self.sqrt_alphas_cumprod[t_index]) + (
-                self.sqrt_one_minus_alphas_cumprod[t_index-1] * epsilon)
+        # x0 and the step to t_index-1 folded into two coefficients,
+        # which also covers t_index == 0
+        model_mean = _x0_step_fused(
+            x, epsilon, self.ddim_eps_coef_eps[t_index], self.ddim_eps_coef_xt[t_index])
 
         return model_mean, latent_features
 
     def ddim2ddpm(self, x, latents, t_index):
-        # boardcasting t_index into a tensor
-        t_tensor = torch.tensor(t_index).repeat(x.shape[0]).to(x.device)
+        t_tensor = self.t_tensor(x, t_index)
 
         # Equation 11 in the paper
         # Use our model (noise predictor) to predict the mean
-        epsilon, latent_features = self(x, latents, t_tensor)
+        epsilon, latent_features = self.denoise(x, latents, t_tensor)
 
+        # x0 and the noisy step to t-1 folded into precomputed coefficients,
+        # no noise is added on the last step
         if t_index == 0:
-            model_mean = (
-                x - self.sqrt_one_minus_alphas_cumprod[t_index] * epsilon) / self.sqrt_alphas_cumprod[t_index]
+            model_mean = _x0_step_fused(
+                x, epsilon, self.ddim2ddpm_coef_eps[t_index], self.ddim2ddpm_coef_xt[t_index])
         else:
-            sigma = (self.sqrt_one_minus_alphas_cumprod[t_index-1]/self.sqrt_one_minus_alphas_cumprod[t_index]) * (
-                torch.sqrt(1-self.alphas[t_index]))
-            model_mean = (self.sqrt_alphas_cumprod[t_index-1]) * (
-                (x - self.sqrt_one_minus_alphas_cumprod[t_index] * epsilon) / self.sqrt_alphas_cumprod[t_index]) + (
-                torch.sqrt(1 - self.sqrt_alphas_cumprod[t_index-1]**2 - sigma**2) * epsilon) + sigma * torch.randn_like(x)
+            model_mean = _x0_noisy_step_fused(x, epsilon, self.noise_like(x),
+                                              self.ddim2ddpm_coef_eps[t_index],
+                                              self.ddim2ddpm_coef_xt[t_index],
+                                              self.ddpm_x0_sigma[t_index])
 
         return model_mean, latent_features
 
+    def cfg_denoise(self, x, latents, t_tensor, sampling=True, **kwargs):
+        # conditional and unconditional predictions in a single (2B, ...) forward,
+        # the second half of the batch gets zeroed latents and, if sampling,
+        # is masked as unconditional
+        b = x.shape[0]
+        uncond_mask = torch.arange(2*b, device=x.device) >= b if sampling else False
+        x0_pred, latent_features = self.denoise(torch.cat([x, x]),
+                                                torch.cat([latents, torch.zeros_like(latents)]),
+                                                torch.cat([t_tensor, t_tensor]),
+                                                sampling=uncond_mask, **kwargs)
+        x0_pred_c, x0_pred_0 = x0_pred.chunk(2)
+        return x0_pred_c, x0_pred_0, latent_features[:b]
+
     def cfdg_ddpm_x0(self, x, latents, t_index):
         """Classifier-free guidance DDPM sampling with x0 parameterization
         Args:
@@ -1810,121 +2063,93 @@ class LatentRollDiffusion(pl.LightningModule):
             latents: DAC latents for conditioning (B, 72/96, T)
             t_index: current timestep
         """
-        t_tensor = torch.tensor(t_index).repeat(x.shape[0]).to(x.device)
+        # w = 0 reduces the guidance to the conditional prediction alone,
+        # the unconditional forward is skipped
+        if self.hparams.sampling.w == 0:
+            return self.ddpm_x0(x, latents, t_index)
 
-        # Get conditional prediction
-        x0_pred_c, latent_features = self(x, latents, t_tensor)
-        # Get unconditional prediction
-        x0_pred_0, _ = self(x, torch.zeros_like(
-            latents), t_tensor, sampling=True)
+        t_tensor = self.t_tensor(x, t_index)
+
+        # Get conditional and unconditional predictions in one forward
+        x0_pred_c, x0_pred_0, latent_features = self.cfg_denoise(
+            x, latents, t_tensor)
         # Combine predictions using guidance weight
         x0_pred = (1+self.hparams.sampling.w)*x0_pred_c - \
             self.hparams.sampling.w*x0_pred_0
 
-        if t_index == 0:
-            sigma = (1/self.sqrt_one_minus_alphas_cumprod[t_index]) * (
-                torch.sqrt(1-self.alphas[t_index]))
-            model_mean = x0_pred / self.sqrt_alphas_cumprod[t_index]
-        else:
-            sigma = (self.sqrt_one_minus_alphas_cumprod[t_index-1]/self.sqrt_one_minus_alphas_cumprod[t_index]) * (
-                torch.sqrt(1-self.alphas[t_index]))
-            model_mean = (self.sqrt_alphas_cumprod[t_index-1]) * x0_pred + (
-                torch.sqrt(1 - self.sqrt_alphas_cumprod[t_index-1]**2 - sigma**2) * (
-                    x-self.sqrt_alphas_cumprod[t_index] * x0_pred)/self.sqrt_one_minus_alphas_cumprod[t_index]) + (
-                sigma * torch.randn_like(x))
+        model_mean = self.x0_posterior(x, x0_pred, t_index)
 
         return model_mean, latent_features
 
     def generation_ddpm_x0(self, x, latents, t_index):
         # x is x_t, when t=T it is pure Gaussian
 
-        # boardcasting t_index into a tensor
-        t_tensor = torch.tensor(t_index).repeat(x.shape[0]).to(x.device)
+        t_tensor = self.t_tensor(x, t_index)
 
         # Equation 11 in the paper
         # Use our model (noise predictor) to predict the mean
         # if sampling = True, the input condition will be overwritten
-        x0_pred_0, _ = self(x, torch.zeros_like(
+        x0_pred_0, _ = self.denoise(x, torch.zeros_like(
             latents), t_tensor, sampling=True)
         x0_pred = x0_pred_0
 
 #         x0_pred = x0_pred_c
         # x0_pred = x0_pred_0
 
-        if t_index == 0:
-            sigma = (1/self.sqrt_one_minus_alphas_cumprod[t_index]) * (
-                torch.sqrt(1-self.alphas[t_index]))
-            model_mean = x0_pred / self.sqrt_alphas_cumprod[t_index]
-        else:
-            sigma = (self.sqrt_one_minus_alphas_cumprod[t_index-1]/self.sqrt_one_minus_alphas_cumprod[t_index]) * (
-                torch.sqrt(1-self.alphas[t_index]))
-            model_mean = (self.sqrt_alphas_cumprod[t_index-1]) * x0_pred + (
-                torch.sqrt(1 - self.sqrt_alphas_cumprod[t_index-1]**2 - sigma**2) * (
-                    x-self.sqrt_alphas_cumprod[t_index] * x0_pred)/self.sqrt_one_minus_alphas_cumprod[t_index]) + (
-                sigma * torch.randn_like(x))
+        model_mean = self.x0_posterior(x, x0_pred, t_index)
 
         return model_mean, _
 
     def inpainting_ddpm_x0(self, x, latents, t_index):
         # x is x_t, when t=T it is pure Gaussian
 
-        # boardcasting t_index into a tensor
-        t_tensor = torch.tensor(t_index).repeat(x.shape[0]).to(x.device)
+        t_tensor = self.t_tensor(x, t_index)
 
         # Equation 11 in the paper
         # Use our model (noise predictor) to predict the mean
-        x0_pred_c, latent_features = self(
-            x, latents, t_tensor, inpainting_t=self.hparams.inpainting_t, inpainting_f=self.hparams.inpainting_f)
-        # if sampling = True, the input condition will be overwritten
-        x0_pred_0, _ = self(x, torch.zeros_like(
-            latents), t_tensor, sampling=True)
-        x0_pred = (1+self.hparams.sampling.w)*x0_pred_c - \
-            self.hparams.sampling.w*x0_pred_0
+        # the unconditional half is overwritten entirely, so inpainting only
+        # affects the conditional prediction
+        inpainting = dict(inpainting_t=self.hparams.inpainting_t,
+                          inpainting_f=self.hparams.inpainting_f)
+        if self.hparams.sampling.w == 0:
+            # no guidance, only the conditional prediction is needed
+            x0_pred, latent_features = self.denoise(x, latents, t_tensor, **inpainting)
+        else:
+            x0_pred_c, x0_pred_0, latent_features = self.cfg_denoise(
+                x, latents, t_tensor, **inpainting)
+            x0_pred = (1+self.hparams.sampling.w)*x0_pred_c - \
+                self.hparams.sampling.w*x0_pred_0
        #  x0_pred = x0_pred_c
         # x0_pred = x0_pred_0
 
-        if t_index == 0:
-            sigma = (1/self.sqrt_one_minus_alphas_cumprod[t_index]) * (
-                torch.sqrt(1-self.alphas[t_index]))
-            model_mean = x0_pred / self.sqrt_alphas_cumprod[t_index]
-        else:
-            sigma = (self.sqrt_one_minus_alphas_cumprod[t_index-1]/self.sqrt_one_minus_alphas_cumprod[t_index]) * (
-                torch.sqrt(1-self.alphas[t_index]))
-            model_mean = (self.sqrt_alphas_cumprod[t_index-1]) * x0_pred + (
-                torch.sqrt(1 - self.sqrt_alphas_cumprod[t_index-1]**2 - sigma**2) * (
-                    x-self.sqrt_alphas_cumprod[t_index] * x0_pred)/self.sqrt_one_minus_alphas_cumprod[t_index]) + (
-                sigma * torch.randn_like(x))
+        model_mean = self.x0_posterior(x, x0_pred, t_index)
 
         return model_mean, latent_features
 
     def cfdg_ddim_x0(self, x, latents, t_index):
         # x is x_t, when t=T it is pure Gaussian
 
-        # boardcasting t_index into a tensor
-        t_tensor = torch.tensor(t_index).repeat(x.shape[0]).to(x.device)
+        # w = 0 reduces the guidance to the conditional prediction alone,
+        # the unconditional forward is skipped
+        if self.hparams.sampling.w == 0:
+            return self.ddim_x0(x, latents, t_index)
 
-        # Equation 11 in the paper
-        # Use our model (noise predictor) to predict the mean
-        x0_pred, latent_features = self(x, latents, t_tensor)
+        t_tensor = self.t_tensor(x, t_index)
 
         # Equation 11 in the paper
         # Use our model (noise predictor) to predict the mean
-        x0_pred_c, latent_features = self(x, latents, t_tensor)
-        x0_pred_0, _ = self(x, torch.zeros_like(latents), t_tensor)
+        # the unconditional half only sees zeroed latents, the model does not
+        # overwrite them
+        x0_pred_c, x0_pred_0, latent_features = self.cfg_denoise(
+            x, latents, t_tensor, sampling=False)
         x0_pred = (1+self.hparams.sampling.w)*x0_pred_c - \
             self.hparams.sampling.w*x0_pred_0
 #         x0_pred = x0_pred_c
         # x0_pred = x0_pred_0
 
-        if t_index == 0:
-            sigma = 0
-            model_mean = x0_pred / self.sqrt_alphas_cumprod[t_index]
-        else:
-            sigma = 0
-            model_mean = (self.sqrt_alphas_cumprod[t_index-1]) * x0_pred + (
-                torch.sqrt(1 - self.sqrt_alphas_cumprod[t_index-1]**2 - sigma**2) * (
-                    x-self.sqrt_alphas_cumprod[t_index] * x0_pred)/self.sqrt_one_minus_alphas_cumprod[t_index]) + (
-                sigma * torch.randn_like(x))
+        # sigma = 0, the update is linear in x0_pred and x_t with precomputed coefficients
+        model_mean = _x0_step_fused(
+            x, x0_pred, self.ddim_coef_x0[t_index], self.ddim_coef_xt[t_index])
 
         return model_mean, latent_features
 
@@ -1932,29 +2157,33 @@ class LatentRollDiffusion(pl.LightningModule):
         optimizer = torch.optim.Adam(self.parameters(), lr=self.hparams.lr)
         return [optimizer]
 
-    def animate_sampling(self, t_idx, fig, ax_flat, caxs, noise_list):
-        # Tuple of (x_t, t), (x_t-1, t-1), ... (x_0, 0)
+    def animate_sampling(self, t_idx, fig, ax_flat, caxs, x_by_t):
+        # x_by_t maps t to the roll stored at that step, x_T under t=timesteps
         # x_t (B, 1, T, F)
-        # clearing figures to prevent slow down in each iteration.d
-        fig.canvas.draw()
-        # visualize only 4 piano rolls
-        for idx in range(len(noise_list[0][0])):
-            ax_flat[idx].cla()
-            ax_flat[4+idx].cla()
-            caxs[idx].cla()
-            caxs[4+idx].cla()
-
-            # roll_pred (1, T, F)
-            im1 = ax_flat[idx].imshow(
-                noise_list[0][0][idx][0].detach().T.cpu(), aspect='auto', origin='lower')
-            im2 = ax_flat[4+idx].imshow(noise_list[1+self.hparams.timesteps-t_idx]
-                                        [0][idx][0].T, aspect='auto', origin='lower')
-            fig.colorbar(im1, cax=caxs[idx])
-            fig.colorbar(im2, cax=caxs[4+idx])
+        x_prev = x_by_t[t_idx]
+        # images, colorbars and labels are built on the first frame only,
+        # later frames just swap the data of the x_{t-1} row
+        if not ax_flat[4].images:
+            # visualize only 4 piano rolls, x_T copied to host in a single transfer
+            x_T = x_by_t[self.hparams.timesteps][:4, 0].detach().transpose(-1, -2).cpu()
+            for idx in range(len(x_prev)):
+                # roll_pred (1, T, F)
+                im1 = ax_flat[idx].imshow(
+                    x_T[idx], aspect='auto', origin='lower')
+                im2 = ax_flat[4+idx].imshow(
+                    x_prev[idx][0].T, aspect='auto', origin='lower')
+                fig.colorbar(im1, cax=caxs[idx])
+                fig.colorbar(im2, cax=caxs[4+idx])
+            row1_txt = ax_flat[0].text(-400, 45, f'Gaussian N(0,1)')
+            row2_txt = ax_flat[4].text(-300, 45, 'x_{t-1}')
+        else:
+            for idx in range(len(x_prev)):
+                im2 = ax_flat[4+idx].images[0]
+                im2.set_data(x_prev[idx][0].T)
+                # rescale like a fresh imshow, the colorbar follows the image
+                im2.autoscale()
 
         fig.suptitle(f't={t_idx}')
-        row1_txt = ax_flat[0].text(-400, 45, f'Gaussian N(0,1)')
-        row2_txt = ax_flat[4].text(-300, 45, 'x_{t-1}')
 
     def visualize_forward_diffusion(self, clean_roll, save_path=None):
         """Visualize the forward diffusion process by showing how a clean piano roll
@@ -1982,7 +2211,7 @@ class LatentRollDiffusion(pl.LightningModule):
             # Sample noised version using q_sample
             noised_roll = q_sample(
                 x_start=clean_roll,
-                t=torch.tensor([t]).to(clean_roll.device),
+                t=torch.full((1,), t, dtype=torch.long, device=clean_roll.device),
                 sqrt_alphas_cumprod=self.sqrt_alphas_cumprod,
                 sqrt_one_minus_alphas_cumprod=self.sqrt_one_minus_alphas_cumprod,
                 noise=noise
@@ -2060,97 +2289,44 @@ def extract_notes_wo_velocity_torch(onsets, frames, onset_threshold=0.5, frame_t
     intervals: np.ndarray of rows containing (onset_index, offset_index)
     velocities: np.ndarray of velocity values
     """
-    onsets = (onsets > onset_threshold).long()
-    frames = (frames > frame_threshold).long()
-    # Make sure the activation is only 1 time-step
-    onset_diff = torch.cat(
-        [onsets[:1, :], onsets[1:, :] - onsets[:-1, :]], dim=0) == 1
-
-    if rule == 'rule2':
-        pass
-    elif rule == 'rule1':
-        # Use in simple models
-        # New condition such that both onset and frame on to get a note
-        onset_diff = onset_diff & (frames == 1)
-    else:
-        raise NameError('Please enter the correct rule name')
-
-    pitches = []
-    intervals = []
-
-    for nonzero in torch.nonzero(onset_diff):
-        frame = nonzero[0].item()
-        pitch = nonzero[1].item()
-
-        onset = frame
-        offset = frame
-
-        # This while loop is looking for where does the note ends
-        while onsets[offset, pitch] or frames[offset, pitch]:
-            offset += 1
-            if offset == onsets.shape[0]:
-                break
-
-        # After knowing where does the note start and end, we can return the pitch information (and velocity)
-        if offset > onset:
-            pitches.append(pitch)
-            intervals.append([onset, offset])
-
-    return pitches, intervals
-
-
-def extract_notes_wo_velocity(onsets, frames, onset_threshold=0.5, frame_threshold=0.5, rule='rule1'):
-    """
-    Finds the note timings based on the onsets and frames information
-    Parameters
-    ----------
-    onsets: torch.FloatTensor, shape = [frames, bins]
-    frames: torch.FloatTensor, shape = [frames, bins]
-    velocity: torch.FloatTensor, shape = [frames, bins]
-    onset_threshold: float
-    frame_threshold: float
-    Returns
-    -------
-    pitches: np.ndarray of bin_indices
-    intervals: np.ndarray of rows containing (onset_index, offset_index)
-    velocities: np.ndarray of velocity values
-    """
-    onsets = (onsets > onset_threshold).astype(int)
-    frames = (frames > frame_threshold).astype(int)
-    # Make sure the activation is only 1 time-step
-    onset_diff = np.concatenate(
-        [onsets[:1, :], onsets[1:, :] - onsets[:-1, :]], axis=0) == 1
+    # same search as extract_notes_wo_velocity but kept on the device of the rolls,
+    # only the extracted notes are copied to host
+    onsets = torch.gt(onsets, onset_threshold)
+    frames = torch.gt(frames, frame_threshold)
+    # Make sure the activation is only 1 time-step (rising edges only)
+    onset_diff = torch.empty_like(onsets)
+    onset_diff[0] = onsets[0]
+    torch.gt(onsets[1:], onsets[:-1], out=onset_diff[1:])
 
     if rule == 'rule2':
         pass
     elif rule == 'rule1':
         # Use in simple models
         # New condition such that both onset and frame on to get a note
-        onset_diff = onset_diff & (frames == 1)
+        onset_diff &= frames
     else:
         raise NameError('Please enter the correct rule name')
 
-    pitches = []
-    intervals = []
+    frame_locs, pitch_locs = torch.nonzero(onset_diff, as_tuple=True)
+    # nonzero already synchronised, so the empty check is free
+    if frame_locs.numel() == 0:
+        return [], []
 
-    frame_locs, pitch_locs = np.nonzero(onset_diff)
-    for frame, pitch in zip(frame_locs, pitch_locs):
+    # first inactive frame at or after each onset, the pitch columns laid end to end
+    # with an inactive sentinel frame after each one
+    T = onsets.shape[0]
+    inactive = torch.ones((onsets.shape[1], T + 1), dtype=torch.bool, device=onsets.device)
+    inactive[:, :T] = ~(onsets | frames).T
+    inactive_pos = torch.nonzero(inactive.flatten()).squeeze(1)
+    onset_pos = pitch_locs * (T + 1) + frame_locs
+    offset_locs = inactive_pos[torch.searchsorted(inactive_pos, onset_pos)] - pitch_locs * (T + 1)
 
-        onset = frame
-        offset = frame
+    # After knowing where does the note start and end, we can return the pitch information (and velocity)
+    valid = offset_locs > frame_locs
+    pitches = pitch_locs[valid]
+    intervals = torch.stack([frame_locs[valid], offset_locs[valid]], dim=1)
 
-        # This while loop is looking for where does the note ends
-        while onsets[offset, pitch] or frames[offset, pitch]:
-            offset += 1
-            if offset == onsets.shape[0]:
-                break
-
-        # After knowing where does the note start and end, we can return the pitch information (and velocity)
-        if offset > onset:
-            pitches.append(pitch)
-            intervals.append([onset, offset])
-
-    return np.array(pitches), np.array(intervals)
+    return pitches.tolist(), intervals.tolist()
 
 
 def save_midi(path, pitches, intervals, velocities):
@@ -2163,49 +2339,142 @@ def save_midi(path, pitches, intervals, velocities):
     intervals: list of (onset_index, offset_index)
     velocities: list of velocity values
     """
-    file = MidiFile()
+    ticks_per_second = MIDI_TICKS_PER_BEAT * 2.0
+
+    # convert all pitches Hz -> MIDI numbers in one vectorized call
+    midi_pitches = np.rint(hz_to_midi(np.asarray(pitches, dtype=np.float64))).astype(int)
+    n_notes = len(midi_pitches)
+
+    # events as flat arrays with note_on/note_off of each note interleaved,
+    # so the stable argsort orders equal times like sorting the event list did
+    times = np.asarray(intervals, dtype=np.float64).reshape(-1, 2)[:n_notes].ravel()
+    is_on = np.tile([True, False], n_notes)
+    event_pitches = np.repeat(midi_pitches, 2)
+    velocities = np.asarray(velocities, dtype=np.float64)[:n_notes]
+    # scaled to the MIDI range and clamped on both sides in one pass
+    event_velocities = np.repeat(np.clip((velocities * 127).astype(int), 0, 127), 2)
+    order = np.argsort(times, kind='stable')
+
+    ticks = (times[order] * ticks_per_second).astype(int)
+    delta_ticks = np.diff(ticks, prepend=0)
+    if n_notes > MIDI_FAST_PATH_MIN_NOTES:
+        # long transcriptions skip building one mido Message per event
+        _write_midi_fast(path, is_on[order], event_pitches[order], event_velocities[order],
+                         delta_ticks, MIDI_TICKS_PER_BEAT)
+        return
+
+    file = MidiFile(ticks_per_beat=MIDI_TICKS_PER_BEAT)
     track = MidiTrack()
     file.tracks.append(track)
-    ticks_per_second = file.ticks_per_beat * 2.0
-
-    events = []
-    for i in range(len(pitches)):
-        events.append(
-            dict(type='on', pitch=pitches[i], time=intervals[i][0], velocity=velocities[i]))
-        events.append(
-            dict(type='off', pitch=pitches[i], time=intervals[i][1], velocity=velocities[i]))
-    events.sort(key=lambda row: row['time'])
-
-    last_tick = 0
-    for event in events:
-        current_tick = int(event['time'] * ticks_per_second)
-        velocity = int(event['velocity'] * 127)
-        if velocity > 127:
-            velocity = 127
-        pitch = int(round(hz_to_midi(event['pitch'])))
-        track.append(Message(
-            'note_' + event['type'], note=pitch, velocity=velocity, time=current_tick - last_tick))
-        last_tick = current_tick
+    # all messages built in one comprehension from plain ints and appended at once
+    track.extend([Message('note_on' if on else 'note_off', note=pitch, velocity=velocity, time=delta)
+                  for on, pitch, velocity, delta in zip(is_on[order].tolist(), event_pitches[order].tolist(),
+                                                        event_velocities[order].tolist(), delta_ticks.tolist())])
 
     file.save(path)
 
 
-def sample_timesteps(batch_size, T, alpha=1.0):
+def _write_midi_fast(path, is_on, pitches, velocities, delta_ticks, ticks_per_beat):
+    """
+    Write note events as a single track MIDI file, byte for byte what MidiFile.save
+    writes for the same note_on/note_off messages on channel 0
+    Parameters
+    ----------
+    path: the path to save the MIDI file
+    is_on: np.ndarray of bool, note_on (True) or note_off (False) of each event
+    pitches: np.ndarray of MIDI note numbers
+    velocities: np.ndarray of MIDI velocities
+    delta_ticks: np.ndarray of ticks since the previous event
+    ticks_per_beat: int
+    """
+    delta_ticks = np.asarray(delta_ticks, dtype=np.int64)
+    # same checks as mido, out of range values would otherwise wrap in the uint8 buffer
+    if ((pitches < 0) | (pitches > 127)).any() or ((velocities < 0) | (velocities > 127)).any():
+        raise ValueError('data byte must be in range 0..127')
+    if (delta_ticks < 0).any():
+        raise ValueError('message time must be non-negative in MIDI file')
+    if (delta_ticks > 0x0fffffff).any():
+        raise ValueError('message time must fit in a 4 byte variable-length quantity')
+    status = np.where(is_on, 0x90, 0x80).astype(np.uint8)
+    # running status, the status byte is only written when it changes
+    new_status = np.ones(len(status), dtype=bool)
+    new_status[1:] = status[1:] != status[:-1]
+    # variable-length deltas, 7 bits per byte with the most significant byte first
+    n_delta = 1 + (delta_ticks >> 7 > 0) + (delta_ticks >> 14 > 0) + (delta_ticks >> 21 > 0)
+    sizes = n_delta + new_status + 2
+    starts = np.cumsum(sizes) - sizes
+
+    data = np.empty(sizes.sum(), dtype=np.uint8)
+    for k in range(4):
+        has = n_delta > k
+        remaining = n_delta[has] - 1 - k
+        # continuation bit set on every delta byte but the last
+        data[starts[has] + k] = ((delta_ticks[has] >> (7 * remaining)) & 0x7f) | np.where(remaining > 0, 0x80, 0)
+    pos = starts + n_delta
+    data[pos[new_status]] = status[new_status]
+    pos += new_status
+    data[pos] = pitches
+    data[pos + 1] = velocities
+
+    # end_of_track meta event, which mido appends when saving
+    track = data.tobytes() + b'\x00\xff\x2f\x00'
+    with open(path, 'wb') as f:
+        f.write(b'MThd' + struct.pack('>Lhhh', 6, 1, 1, ticks_per_beat))
+        f.write(b'MTrk' + struct.pack('>L', len(track)) + track)
+
+
+def export_midi(np_frame, scaling, generation_filter, clean_path, raw_path):
+    """
+    Extract the notes of one predicted roll and save them as MIDI
+    Parameters
+    ----------
+    np_frame: np.ndarray, shape = [frames, bins]
+    scaling: seconds per frame
+    generation_filter: minimum duration (seconds) of the notes kept in the clean MIDI
+    clean_path: the path of the MIDI without the short notes
+    raw_path: the path of the MIDI with every note
+    """
+    p_est, i_est = extract_notes_wo_velocity(np_frame, np_frame)
+
+    # Converting time steps to seconds and midi number to frequency
+    i_est = (i_est * scaling).reshape(-1, 2)
+    p_est = PITCH_HZ[p_est]
+
+    clean_notes = (i_est[:, 1]-i_est[:, 0]) > generation_filter
+
+    save_midi(clean_path, p_est[clean_notes], i_est[clean_notes], [127]*len(p_est))
+    save_midi(raw_path, p_est, i_est, [127]*len(p_est))
+
+
+def sample_timesteps(batch_size, T, alpha=1.0, device=None):
     """
     alpha > 0 => sample more from high t
     alpha = 0 => uniform
     alpha < 0 => sample more from low t
+    device: where the cdf is kept and the timesteps are sampled
     """
+    # the cdf only depends on (T, alpha), so it is built once per device and cached
+    cdf = _timestep_cdf(int(T), float(alpha), device)
+    # sample from it, return tensor of same (batch_size,)
+    return sample_from_cdf(cdf, batch_size)
+
+
+@functools.lru_cache(maxsize=16)
+def _timestep_cdf(T, alpha, device=None):
     # t ~ p(t) = c * (t/T)^alpha
     # We'll do a discrete distribution
     # e.g. create a pmf ~ (i/T)^alpha for i in [0..T-1].
-
-    i = torch.arange(T, dtype=torch.float)  # 0..T-1
+    i = torch.arange(T, dtype=torch.float, device=device)  # 0..T-1
     pmf = (i / (T-1) + 1e-8) ** alpha
-    pmf = pmf / pmf.sum()
     # now pmf is shape (T,)
-    # sample from it, return tensor of same (batch_size,)
-    return torch.multinomial(pmf, batch_size, replacement=True)
+    return torch.cumsum(pmf / pmf.sum(), 0)
+
+
+def sample_from_cdf(cdf, batch_size):
+    # inverse-CDF sampling, a binary search per sample instead of torch.multinomial,
+    # clamped since the last entry of a float cumsum can fall just short of 1
+    u = torch.rand(batch_size, device=cdf.device)
+    return torch.searchsorted(cdf, u).clamp_(max=cdf.shape[0] - 1)
 
 
 def curriculum_sample_timesteps(batch_size,
@@ -2214,7 +2483,8 @@ def curriculum_sample_timesteps(batch_size,
                                 max_epochs,
                                 alpha=1.0,
                                 min_t_ratio=0.1,
-                                full_t_ratio=0.5):
+                                full_t_ratio=0.5,
+                                device=None):
     """
     Sample timesteps with curriculum learning - gradually increasing the maximum timestep
     as training progresses.
@@ -2229,6 +2499,7 @@ def curriculum_sample_timesteps(batch_size,
                - positive alpha: favors smaller timesteps (e.g., 1.5)
                - negative alpha: favors larger timesteps (e.g., -1.5)
                - zero: uniform distribution
+        device: Device the timesteps are sampled on, the cdf is cached there
 
     Returns:
         Tensor of sampled timesteps
@@ -2243,12 +2514,16 @@ def curriculum_sample_timesteps(batch_size,
     # - positive alpha: favors smaller timesteps
     # - negative alpha: favors larger timesteps
     # - zero: uniform distribution
-    t_values = torch.linspace(1, max_t, max_t)
     if alpha == 0:
-        # Uniform distribution
-        probs = torch.ones_like(t_values)
-    else:
-        probs = t_values ** (-alpha)
+        # Uniform distribution, no cdf needed
+        return torch.randint(0, max_t, (batch_size,), device=device)
+    return sample_from_cdf(_curriculum_cdf(max_t, float(alpha), device), batch_size)
+
 
+@functools.lru_cache(maxsize=64)
+def _curriculum_cdf(max_t, alpha, device=None):
+    # max_t only changes with the epoch, so the cdf is cached per (max_t, alpha, device)
+    t_values = torch.linspace(1, max_t, max_t, device=device)
+    probs = t_values ** (-alpha)
     probs = probs / probs.sum()
-    return torch.multinomial(probs, batch_size, replacement=True).long()
+    return torch.cumsum(probs, 0)
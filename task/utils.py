@@ -17,38 +17,67 @@ def extract_notes_wo_velocity(onsets, frames, onset_threshold=0.5, frame_thresho
     intervals: np.ndarray of rows containing (onset_index, offset_index)
     velocities: np.ndarray of velocity values
     """
-    onsets = (onsets > onset_threshold).astype(int)
-    frames = (frames > frame_threshold).astype(int)
-    onset_diff = np.concatenate([onsets[:1, :], onsets[1:, :] - onsets[:-1, :]], axis=0) == 1 # Make sure the activation is only 1 time-step
+    onsets = onsets > onset_threshold
+    frames = frames > frame_threshold
+    if not onsets.any():
+        # silent roll, nothing to search
+        return np.empty(0, dtype=np.intp), np.empty((0, 2), dtype=np.intp)
+    # Make sure the activation is only 1 time-step (rising edges only),
+    # written in one pass into a single bool array
+    onset_diff = np.empty_like(onsets)
+    onset_diff[0] = onsets[0]
+    np.greater(onsets[1:], onsets[:-1], out=onset_diff[1:])
     if rule=='rule2':
         pass
     elif rule=='rule1':
         # Use in simple models
-        onset_diff = onset_diff & (frames==1) # New condition such that both onset and frame on to get a note
+        onset_diff &= frames # New condition such that both onset and frame on to get a note
     else:
         raise NameError('Please enter the correct rule name')
 
-    pitches = []
-    intervals = []
+    frame_locs, pitch_locs = np.nonzero(onset_diff)
+    if frame_locs.size == 0:
+        return pitch_locs, np.empty((0, 2), dtype=np.intp)
 
-    dim1, dim2 = np.nonzero(onset_diff)    
-    for frame, pitch in zip(dim1, dim2):
-        # The below code is for torch
-        # frame = nonzero[0].item()
-        # pitch = nonzero[1].item()
+    # a note lasts until the first frame where neither onset nor frame is active (T if none).
+    # With the pitch columns laid end to end, plus an inactive sentinel row at T,
+    # that frame is the first inactive position at or after the onset, found for
+    # all onsets at once with searchsorted
+    T = onsets.shape[0]
+    inactive = np.ones((onsets.shape[1], T + 1), dtype=bool)
+    inactive[:, :T] = ~(onsets | frames).T
+    inactive_pos = np.flatnonzero(inactive)
+    onset_pos = pitch_locs * (T + 1) + frame_locs
+    offset_locs = inactive_pos[np.searchsorted(inactive_pos, onset_pos)] - pitch_locs * (T + 1)
 
-        onset = frame
-        offset = frame
+    # After knowing where does the note start and end, we can return the pitch information (and velocity)
+    valid = offset_locs > frame_locs
+    pitches = pitch_locs[valid]
+    intervals = np.stack([frame_locs[valid], offset_locs[valid]], axis=1)
 
-        # This while loop is looking for where does the note ends        
-        while onsets[offset, pitch].item() or frames[offset, pitch].item():
-            offset += 1
-            if offset == onsets.shape[0]:
-                break
+    return pitches, intervals
 
-        # After knowing where does the note start and end, we can return the pitch information (and velocity)        
-        if offset > onset:
-            pitches.append(pitch)
-            intervals.append([onset, offset])
 
-    return np.array(pitches), np.array(intervals)
\ No newline at end of file
+def frame_precision_recall_f1(label, pred):
+    """
+    Frame-level precision, recall and F1 from three boolean reductions,
+    same as sklearn's precision_recall_fscore_support(average='binary')
+    but without flattening the rolls into NumPy. Undefined scores are 0.
+    Parameters
+    ----------
+    label: torch.Tensor or np.ndarray, nonzero entries are positive
+    pred: torch.Tensor or np.ndarray of bool, same shape as label
+    Returns
+    -------
+    precision, recall, f1: float
+    """
+    label = torch.as_tensor(label).bool()
+    pred = torch.as_tensor(pred, device=label.device).bool()
+    tp = (pred & label).sum().double()
+    fp = (pred & ~label).sum().double()
+    fn = (~pred & label).sum().double()
+
+    precision = (tp / (tp + fp)).nan_to_num(0.)
+    recall = (tp / (tp + fn)).nan_to_num(0.)
+    f1 = (2 * tp / (2 * tp + fp + fn)).nan_to_num(0.)
+    return precision.item(), recall.item(), f1.item()
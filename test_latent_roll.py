@@ -20,21 +20,25 @@ def main(cfg):
     # test_set = getattr(MusicDataset, cfg.dataset.name)(**cfg.dataset.test)
     # test_loader = DataLoader(test_set, batch_size=4)
     test_set = ChunkedDataset((getattr(MusicDataset, cfg.dataset.name)(**cfg.dataset.test)), num_chunks=num_chunks)
-    test_loader = DataLoader(test_set, batch_size=4) # was batch size 4
+    # pinned host batches let Lightning copy them to the GPU with non_blocking=True
+    test_loader = DataLoader(test_set, batch_size=4, # was batch size 4
+                             num_workers=cfg.dataloader.test.num_workers,
+                             pin_memory=cfg.dataloader.test.pin_memory)
 
     # Model
     if cfg.task.frame_threshold != None and cfg.task.sampling.type != None:
         model = getattr(Model, cfg.model.name).load_from_checkpoint(to_absolute_path(
-            cfg.checkpoint_path), frame_threshold=cfg.task.frame_threshold, sampling=cfg.task.sampling, timesteps=cfg.task.timesteps)
+            cfg.checkpoint_path), frame_threshold=cfg.task.frame_threshold, sampling=cfg.task.sampling, timesteps=cfg.task.timesteps,
+            bf16_sampling=cfg.task.bf16_sampling)
     elif cfg.task.frame_threshold == None and cfg.task.sampling.type != None:
         model = getattr(Model, cfg.model.name).load_from_checkpoint(
-            to_absolute_path(cfg.checkpoint_path), sampling=cfg.task.sampling)
+            to_absolute_path(cfg.checkpoint_path), sampling=cfg.task.sampling, bf16_sampling=cfg.task.bf16_sampling)
     elif cfg.task.frame_threshold != None and cfg.task.sampling.type == None:
         model = getattr(Model, cfg.model.name).load_from_checkpoint(
-            to_absolute_path(cfg.checkpoint_path), frame_threshold=cfg.task.frame_threshold)
+            to_absolute_path(cfg.checkpoint_path), frame_threshold=cfg.task.frame_threshold, bf16_sampling=cfg.task.bf16_sampling)
     else:
         model = getattr(Model, cfg.model.name).load_from_checkpoint(
-            to_absolute_path(cfg.checkpoint_path))
+            to_absolute_path(cfg.checkpoint_path), bf16_sampling=cfg.task.bf16_sampling)
 
     if cfg.model.name == 'ClassifierFreeLatentRoll':
         name = f"Test-x0_pred_0-{cfg.model.name}-" \